@@ -0,0 +1,161 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Animation converter
+
+Turns images of any size, animated GIFs, directories of frames and
+videos (with ffmpeg) into a sprite animation: a stream of 12x12
+frames of 18 bytes each, as sent with the sprite data command, one
+after another without a header. The bring-up script plays such a
+file with one frame per next_frame.
+
+Frames are read, scaled, quantized and written one at a time, so
+memory does not grow with the length of the animation.
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence
+
+from sprite2bit import SPRITE_WIDTH, SPRITE_HEIGHT, to_bytes
+
+ANIMATION = "bring-up/tt_um_top_mole99/animation.bin"
+
+VIDEO = {".mp4", ".mkv", ".webm", ".mov", ".avi", ".m4v", ".mpg", ".mpeg"}
+
+# Ordered dithering with a 4x4 Bayer matrix,
+# thresholds in the middle of their interval
+BAYER = np.array([
+    [ 0,  8,  2, 10],
+    [12,  4, 14,  6],
+    [ 3, 11,  1,  9],
+    [15,  7, 13,  5],
+])
+ORDERED = np.tile((BAYER + 0.5) * 16, (SPRITE_HEIGHT // 4, SPRITE_WIDTH // 4))
+
+DITHER = ("threshold", "ordered", "floyd")
+
+def video_frames(source, fps=None, fit="crop"):
+    """Frames of a video, scaled to a sprite by ffmpeg"""
+
+    if not shutil.which("ffmpeg"):
+        raise RuntimeError(f"ffmpeg is needed to read {source}")
+
+    # Commas separate filters, escape the ones in expressions
+    side = "min(iw\\,ih)" if fit == "crop" else "max(iw\\,ih)"
+    filters = [f"fps={fps}"] if fps else []
+    if fit == "crop":
+        filters.append(f"crop={side}:{side}")
+    elif fit == "pad":
+        filters.append(f"pad={side}:{side}:(ow-iw)/2:(oh-ih)/2:white")
+    filters.append(f"scale={SPRITE_WIDTH}:{SPRITE_HEIGHT}:flags=area")
+
+    ffmpeg = subprocess.Popen(["ffmpeg", "-v", "error", "-i", str(source), "-vf", ",".join(filters),
+                               "-f", "rawvideo", "-pix_fmt", "gray", "-"], stdout=subprocess.PIPE)
+    try:
+        size = SPRITE_WIDTH * SPRITE_HEIGHT
+        while frame := ffmpeg.stdout.read(size):
+            if len(frame) < size:
+                break
+            yield Image.frombytes("L", (SPRITE_WIDTH, SPRITE_HEIGHT), frame)
+    finally:
+        ffmpeg.stdout.close()
+        ffmpeg.kill()
+        ffmpeg.wait()
+
+def image_frames(source):
+    """Frames of an image, one for still images, every frame
+    of an animated one, decoded when they are needed"""
+
+    with Image.open(source) as image:
+        for frame in ImageSequence.Iterator(image):
+            yield frame
+
+def frames(sources, fps=None, fit="crop"):
+    """Frames of all sources, directories in name order"""
+
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            yield from frames(sorted(path for path in source.iterdir() if path.is_file()), fps, fit)
+        elif source.suffix.lower() in VIDEO:
+            yield from video_frames(source, fps, fit)
+        else:
+            yield from image_frames(source)
+
+def scale(frame, fit="crop"):
+    """Frame as grayscale sprite, transparent pixels are white"""
+
+    if frame.size == (SPRITE_WIDTH, SPRITE_HEIGHT) and frame.mode == "L":
+        return frame
+
+    frame = frame.convert("RGBA")
+    background = Image.new("RGBA", frame.size, "white")
+    frame = Image.alpha_composite(background, frame).convert("L")
+
+    size = (SPRITE_WIDTH, SPRITE_HEIGHT)
+    if fit == "crop":
+        return ImageOps.fit(frame, size, Image.BOX)
+    if fit == "pad":
+        return ImageOps.pad(frame, size, Image.BOX, color=255)
+    return frame.resize(size, Image.BOX)
+
+def quantize(frame, dither="threshold", threshold=128, invert=False):
+    """Sprite as array of rows, dark pixels are 1"""
+
+    if dither == "floyd":
+        # Error diffusion by PIL, which always thresholds at 128
+        sprite = np.asarray(frame.convert("1", dither=Image.FLOYDSTEINBERG)) == 0
+    else:
+        pixels = np.asarray(frame)
+        sprite = pixels < (ORDERED if dither == "ordered" else threshold)
+
+    if invert:
+        sprite = ~sprite
+
+    return sprite.astype(np.uint8)
+
+def stream(sources, dither="threshold", threshold=128, invert=False, fit="crop", fps=None):
+    """Generator of the 18 bytes of every frame"""
+
+    for frame in frames(sources, fps, fit):
+        yield to_bytes(quantize(scale(frame, fit), dither, threshold, invert))
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert images and videos into a sprite animation")
+    parser.add_argument("sources", nargs="+", help="images, animated images, directories of frames or videos")
+    parser.add_argument("-o", "--out", default=ANIMATION, help="animation file, - for stdout")
+    parser.add_argument("-d", "--dither", choices=DITHER, default="threshold", help="quantization")
+    parser.add_argument("-t", "--threshold", type=int, default=128, help="gray level below which a pixel is set")
+    parser.add_argument("-i", "--invert", action="store_true", help="set bright pixels instead of dark ones")
+    parser.add_argument("--fit", choices=("crop", "pad", "stretch"), default="crop",
+                        help="how frames that are not square become 12x12")
+    parser.add_argument("--fps", type=float, help="resample videos to this frame rate, 60 is one frame per next_frame")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = 0
+
+    out = sys.stdout.buffer if args.out == "-" else open(args.out, "wb")
+    try:
+        for data in stream(args.sources, args.dither, args.threshold, args.invert, args.fit, args.fps):
+            out.write(data)
+            count += 1
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Converted {count} frames into {args.out} in {elapsed * 1000:.0f} ms "
+          f"({count / max(elapsed, 1e-9):.0f} frames/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
 # SPI using PIO, which is handy because you can use any pins.
+#
+# By default the CPU moves every byte through the FIFOs of the state
+# machine. With dma=True, which has not been tried on hardware yet,
+# transfers are done by two DMA channels: one feeds the TX FIFO of the
+# state machine from the buffer, one drains the RX FIFO into a buffer,
+# or into a single scratch byte if the read data is not needed. The
+# transfer is complete when the last byte has been received, so the
+# last bit is on the bus before CS can be released.
 
+import asyncio
+import micropython
 import rp2
 from machine import Pin
 
+# FIFO registers and DREQs of the PIO blocks
+PIO_BASE   = (0x50200000, 0x50300000)
+PIO_TXF    = 0x010
+PIO_RXF    = 0x020
+DREQ_PIO_TX = (0, 8)
+DREQ_PIO_RX = (4, 12)
+
 @rp2.asm_pio(out_shiftdir=0, autopull=True, pull_thresh=8, autopush=True, push_thresh=8, sideset_init=(rp2.PIO.OUT_LOW,), out_init=rp2.PIO.OUT_LOW)
 def spi_cpha0():
     out(pins, 1)             .side(0x0)
@@ -13,10 +30,10 @@ def spi_cpha1():
     pull(ifempty)            .side(0x0)
     out(pins, 1)             .side(0x1).delay(1)
     in_(pins, 1)             .side(0x0)
-    
+
 class PIOSPI:
 
-    def __init__(self, sm_id, pin_mosi, pin_miso, pin_sck, cpha=False, cpol=False, freq=1000000):
+    def __init__(self, sm_id, pin_mosi, pin_miso, pin_sck, cpha=False, cpol=False, freq=1000000, dma=False):
         assert(not(cpol))
         if not cpha:
             self._sm = rp2.StateMachine(sm_id, spi_cpha0, freq=2*freq, sideset_base=Pin(pin_sck), out_base=Pin(pin_mosi), in_base=Pin(pin_miso))
@@ -24,8 +41,108 @@ class PIOSPI:
             self._sm = rp2.StateMachine(sm_id, spi_cpha1, freq=4*freq, sideset_base=Pin(pin_sck), out_base=Pin(pin_mosi), in_base=Pin(pin_miso))
         self._sm.active(1)
 
+        self._dma = dma
+        if dma:
+            pio, sm = sm_id // 4, sm_id % 4
+            self._txf = PIO_BASE[pio] + PIO_TXF + 4*sm
+            self._rxf = PIO_BASE[pio] + PIO_RXF + 4*sm
+
+            self._tx = rp2.DMA()
+            self._rx = rp2.DMA()
+
+            # Byte transfers, a byte written to the TX FIFO is replicated
+            # to all byte lanes and ends up in the MSBs the program shifts out
+            self._tx_ctrl = self._tx.pack_ctrl(size=0, inc_write=False, treq_sel=DREQ_PIO_TX[pio] + sm)
+            self._tx_zero_ctrl = self._tx.pack_ctrl(size=0, inc_read=False, inc_write=False, treq_sel=DREQ_PIO_TX[pio] + sm)
+            self._rx_ctrl = self._rx.pack_ctrl(size=0, inc_read=False, treq_sel=DREQ_PIO_RX[pio] + sm, irq_quiet=False)
+            self._rx_drop_ctrl = self._rx.pack_ctrl(size=0, inc_read=False, inc_write=False, treq_sel=DREQ_PIO_RX[pio] + sm, irq_quiet=False)
+
+            self._zero = bytearray(1)
+            self._drop = bytearray(1)
+
+            self._done = asyncio.ThreadSafeFlag()
+            self._rx.irq(self._irq, hard=True)
+
+    def _irq(self, dma):
+        self._done.set()
+
+    def deinit(self):
+        self._sm.active(0)
+        if self._dma:
+            self._tx.close()
+            self._rx.close()
+
+    # Start a transfer of len(wdata) bytes, rdata receives
+    # them if given, wdata None sends zeros, needs dma=True
+    def start(self, wdata, rdata=None, n=None):
+        assert(self._dma)
+        if n is None:
+            n = len(wdata) if wdata is not None else len(rdata)
+        if not n:
+            return
+
+        self._done.clear()
+
+        if rdata is None:
+            self._rx.config(read=self._rxf, write=self._drop, count=n, ctrl=self._rx_drop_ctrl, trigger=True)
+        else:
+            self._rx.config(read=self._rxf, write=rdata, count=n, ctrl=self._rx_ctrl, trigger=True)
+
+        if wdata is None:
+            self._tx.config(read=self._zero, write=self._txf, count=n, ctrl=self._tx_zero_ctrl, trigger=True)
+        else:
+            self._tx.config(read=wdata, write=self._txf, count=n, ctrl=self._tx_ctrl, trigger=True)
+
+    def busy(self):
+        return self._rx.active()
+
     @micropython.native
+    def wait(self):
+        while self._rx.active():
+            pass
+
+    # Transfer in the background, awaits the IRQ of the RX channel
+    async def write_async(self, wdata, rdata=None):
+        self.start(wdata, rdata)
+        if len(wdata):
+            await self._done.wait()
+
     def write(self, wdata):
+        if self._dma:
+            self.start(wdata)
+            self.wait()
+        else:
+            self._write_fifo(wdata)
+
+    def read(self, n):
+        return self.write_read_blocking(bytes(n))
+
+    def readinto(self, rdata):
+        if self._dma:
+            self.start(None, rdata)
+            self.wait()
+        else:
+            self._readinto_fifo(rdata)
+
+    # Like write_read_blocking without allocating the read buffer
+    def write_readinto(self, wdata, rdata):
+        if self._dma:
+            self.start(wdata, rdata, len(wdata))
+            self.wait()
+        else:
+            rdata[:len(wdata)] = self._write_read_fifo(wdata)
+
+    def write_read_blocking(self, wdata):
+        if self._dma:
+            rdata = bytearray(len(wdata))
+            self.write_readinto(wdata, rdata)
+            return rdata
+        return self._write_read_fifo(wdata)
+
+    # Without DMA, every byte goes through the FIFOs by the CPU
+
+    @micropython.native
+    def _write_fifo(self, wdata):
         first = True
         for b in wdata:
             self._sm.put(b, 24)
@@ -34,12 +151,9 @@ class PIOSPI:
             else:
                 first = False
         self._sm.get()
-        
-    def read(self, n):
-        return self.write_read_blocking([0,]*n)
 
     @micropython.native
-    def readinto(self, rdata):
+    def _readinto_fifo(self, rdata):
         self._sm.put(0)
         for i in range(len(rdata)-1):
             self._sm.put(0)
@@ -47,7 +161,7 @@ class PIOSPI:
         rdata[-1] = self._sm.get()
 
     @micropython.native
-    def write_read_blocking(self, wdata):
+    def _write_read_fifo(self, wdata):
         rdata = bytearray(len(wdata))
         i = -1
         for b in wdata:
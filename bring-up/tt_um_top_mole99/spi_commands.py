@@ -0,0 +1,22 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+SPI commands of top.sv, the first byte of a transaction
+
+Used by the testbench, the scene planner and, with MicroPython,
+by the bring-up script, so they all encode transactions alike.
+"""
+
+# Clock cycles from an SPI edge until the design reacts to it:
+# two synchronizer flip-flops, edge detection and the register itself
+LATENCY = 3
+
+CMD_SPRITE_DATA = 0x0
+CMD_COLOR1      = 0x1
+CMD_COLOR2      = 0x2
+CMD_COLOR3      = 0x3
+CMD_COLOR4      = 0x4
+CMD_SPRITE_X    = 0x5
+CMD_SPRITE_Y    = 0x6
+CMD_MISC        = 0x7
@@ -0,0 +1,130 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Sprite bank: named 12x12 sprites in one binary file
+
+Written by sprite2bit.py, read by the testbench and, with
+MicroPython, by the bring-up script. Little endian:
+
+    header  16 bytes    magic "SPRB", version (u16), count (u16),
+                        width, height, bytes per sprite, bytes per
+                        name (u8 each), offset of the first sprite (u32)
+    index   count names, NUL padded to the bytes per name
+    sprites count sprites of 18 bytes, in the order of the index
+
+A sprite is stored as it is sent with the sprite data command:
+row by row, the first pixel in the MSB of the first byte.
+"""
+
+import struct
+
+MAGIC = b"SPRB"
+VERSION = 1
+
+HEADER = "<4sHHBBBBI"
+HEADER_SIZE = 16
+
+SPRITE_WIDTH  = 12
+SPRITE_HEIGHT = 12
+SPRITE_BYTES  = SPRITE_WIDTH * SPRITE_HEIGHT // 8
+
+NAME_BYTES = 16
+
+def pack(sprites):
+    """Bank of sprites given as (name, data)"""
+
+    names = b""
+    data = b""
+    for name, sprite in sprites:
+        name = name.encode()
+        if len(name) > NAME_BYTES:
+            raise ValueError("Sprite name {} is longer than {} bytes".format(name, NAME_BYTES))
+        if len(sprite) != SPRITE_BYTES:
+            raise ValueError("Sprite {} has {} bytes instead of {}".format(name, len(sprite), SPRITE_BYTES))
+        names += name + bytes(NAME_BYTES - len(name))
+        data += bytes(sprite)
+
+    offset = HEADER_SIZE + len(names)
+    header = struct.pack(HEADER, MAGIC, VERSION, len(sprites), SPRITE_WIDTH, SPRITE_HEIGHT,
+                         SPRITE_BYTES, NAME_BYTES, offset)
+
+    return header + names + data
+
+def unpack(sprite):
+    """Rows of pixels of a sprite"""
+
+    return [[(sprite[(y * SPRITE_WIDTH + x) >> 3] >> (7 - ((y * SPRITE_WIDTH + x) & 7))) & 1
+             for x in range(SPRITE_WIDTH)] for y in range(SPRITE_HEIGHT)]
+
+def to_bytes(rows):
+    """Sprite from rows of pixels, the inverse of unpack()"""
+
+    sprite = bytearray(SPRITE_BYTES)
+    for y in range(SPRITE_HEIGHT):
+        for x in range(SPRITE_WIDTH):
+            if rows[y][x]:
+                i = y * SPRITE_WIDTH + x
+                sprite[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(sprite)
+
+class SpriteBank:
+    """Sprites of a bank in a buffer (bytes, mmap) or an open file
+
+    Only the header and the index are read when the bank is opened.
+    With a buffer, sprite() is a slice of it. With a file, it reads
+    the sprite into one preallocated buffer that is reused by the
+    next call, nothing is allocated either way.
+    """
+
+    def __init__(self, source):
+        if hasattr(source, "readinto"):
+            self._file = source
+            self._file.seek(0)
+            head = self._file.read(HEADER_SIZE)
+        else:
+            self._file = None
+            self._buffer = memoryview(source)
+            head = self._buffer[:HEADER_SIZE]
+
+        magic, version, self.count, width, height, sprite_bytes, name_bytes, self._offset = \
+            struct.unpack(HEADER, head)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a sprite bank of version {}".format(VERSION))
+        if (width, height, sprite_bytes, name_bytes) != (SPRITE_WIDTH, SPRITE_HEIGHT, SPRITE_BYTES, NAME_BYTES):
+            raise ValueError("Unsupported sprite bank geometry")
+
+        if self._file:
+            index = self._file.read(self.count * NAME_BYTES)
+            self._sprite = bytearray(SPRITE_BYTES)
+            self._view = memoryview(self._sprite)
+        else:
+            index = self._buffer[HEADER_SIZE:HEADER_SIZE + self.count * NAME_BYTES]
+
+        self.names = [bytes(index[i * NAME_BYTES:(i + 1) * NAME_BYTES]).rstrip(b"\0").decode()
+                      for i in range(self.count)]
+
+    def __len__(self):
+        return self.count
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def sprite(self, index):
+        """The 18 bytes of sprite index"""
+
+        if not 0 <= index < self.count:
+            raise IndexError("Sprite {} is not in the bank".format(index))
+
+        offset = self._offset + index * SPRITE_BYTES
+
+        if self._file:
+            self._file.seek(offset)
+            self._file.readinto(self._sprite)
+            return self._view
+
+        return self._buffer[offset:offset + SPRITE_BYTES]
+
+    def __getitem__(self, name):
+        return self.sprite(self.index(name))
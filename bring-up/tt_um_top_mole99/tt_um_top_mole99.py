@@ -1,68 +1,17 @@
 import sys
+import time
 from machine import Pin
-from machine import SoftSPI
 from .pio_spi import PIOSPI
-from ttboard.demoboard import DemoBoard, Pins
-
-SPRITE_TT = [
-    [0,0,0,1,1,1,1,1,1,0,0,0],
-    [0,0,1,0,0,0,0,0,0,1,0,0],
-    [0,1,1,1,1,1,1,0,0,0,1,0],
-    [1,1,1,1,1,1,1,0,0,0,0,1],
-    [0,0,0,1,1,0,0,0,0,0,0,1],
-    [1,0,0,1,1,1,1,1,1,1,0,1],
-    [1,0,0,1,1,1,1,1,1,1,0,1],
-    [1,0,0,1,1,0,1,1,0,0,0,1],
-    [1,0,0,1,1,0,1,1,0,0,0,1],
-    [0,1,0,0,0,0,1,1,0,0,1,0],
-    [0,0,1,0,0,0,1,1,0,1,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-]
-
-SPRITE_DRINK = [
-    [0,0,0,0,0,0,0,1,1,0,0,0],
-    [0,0,0,0,0,0,1,0,0,0,0,0],
-    [1,1,1,1,0,1,0,1,1,1,1,0],
-    [1,0,0,0,0,1,0,0,0,0,1,0],
-    [0,1,1,1,1,1,1,1,1,1,0,0],
-    [0,0,1,1,0,0,1,1,1,0,0,0],
-    [0,0,0,1,0,0,1,1,0,0,0,0],
-    [0,0,0,0,1,1,1,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-]
+from .sprite_bank import SpriteBank, SPRITE_BYTES
+from .spi_commands import CMD_SPRITE_DATA, CMD_COLOR1, CMD_COLOR2, CMD_COLOR3, CMD_COLOR4, CMD_MISC
+from ttboard.demoboard import DemoBoard
 
-SPRITE_HEART = [
-    [0,0,1,1,0,0,0,1,1,0,0,0],
-    [0,1,1,1,1,0,1,1,1,1,0,0],
-    [1,1,1,1,1,1,1,1,0,1,1,0],
-    [1,1,1,1,1,1,1,1,1,0,1,0],
-    [1,1,1,1,1,1,1,1,1,0,1,0],
-    [1,1,1,1,1,1,1,1,0,1,1,0],
-    [0,1,1,1,1,1,1,1,1,1,0,0],
-    [0,0,1,1,1,1,0,1,1,0,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-    [0,0,0,0,1,1,1,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-]
+# Directory of this script on the board
+DIR = __file__.rsplit('/', 1)[0]
 
-SPRITE_SPIRAL = [
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-    [0,1,1,0,0,0,0,0,1,1,0,0],
-    [1,0,0,0,0,0,0,0,0,0,1,0],
-    [1,0,0,0,0,0,0,0,0,0,1,0],
-    [0,0,0,0,1,1,1,1,0,0,0,1],
-    [0,0,0,1,0,0,0,0,1,0,0,1],
-    [0,0,1,0,0,1,1,0,1,0,0,1],
-    [0,0,1,0,1,0,0,0,1,0,0,1],
-    [0,0,1,0,1,0,0,1,0,0,1,0],
-    [0,0,1,0,0,1,1,0,0,0,1,0],
-    [0,0,0,1,0,0,0,0,1,1,0,0],
-    [0,0,0,0,1,1,1,1,0,0,0,0],
-]
+# Sprites from sprites.bank, written by sprite2bit.py,
+# read from flash one sprite at a time when it is sent
+BANK = SpriteBank(open(DIR + '/sprites.bank', 'rb'))
 
 # Parameters
 WIDTH    = 800
@@ -76,15 +25,6 @@ SPRITE_Y = 0
 SPRITE_HEIGHT = 12
 SPRITE_WIDTH = 12
 
-CMD_SPRITE_DATA = b'\x00'
-CMD_COLOR1      = b'\x01'
-CMD_COLOR2      = b'\x02'
-CMD_COLOR3      = b'\x03'
-CMD_COLOR4      = b'\x04'
-CMD_SPRITE_X    = b'\x05'
-CMD_SPRITE_Y    = b'\x06'
-CMD_MISC        = b'\x07'
-
 COLOR_BLACK = b'\x00'
 COLOR_DARK_GRAY = b'\x15'
 COLOR_GRAY = b'\x2A'
@@ -102,8 +42,8 @@ COLOR_BOLD_BLUE = b'\x03'
 COLOR_BLUE = b'\x02'
 COLOR_LIGHT_BLUE = b'\x01'
 
-COLOR_PINK = '\x31'
-COLOR_DARK_PINK = '\x21'
+COLOR_PINK = b'\x31'
+COLOR_DARK_PINK = b'\x21'
 
 colors = [
     COLOR_BLACK,
@@ -127,6 +67,9 @@ colors = [
     COLOR_WHITE
 ]
 
+# Design clock cycles per microsecond
+CYCLES_PER_US = 40
+
 COLOR1 = '\x31'
 COLOR2 = '\x15'
 COLOR3 = '\x0C'
@@ -160,22 +103,56 @@ def sync():
     for i in range(4):
         sync_line()
 
-def sprite2bytes(sprite):
-    bytes = []
-    
-    bitstring = ''
-    for row in sprite:
-        for bit in row:
-            bitstring += str(bit)
-
-    return int(bitstring, 2).to_bytes(len(bitstring) // 8, 'big')
-
-def send_cmd(tt, spi, cmd, data):
+# Send an encoded transaction with CS low
+def send_frame(tt, spi, data):
     tt.uio_in[0] = 0 # start
-    spi.write(cmd)
     spi.write(data)
     tt.uio_in[0] = 1 # stop
 
+# One transmit buffer for all transactions built at runtime,
+# a command and its data are encoded into it without allocating
+tx = bytearray(1 + SPRITE_BYTES)
+tx_view = memoryview(tx)
+tx_byte = tx_view[:2]
+tx_sprite = tx_view[1:]
+
+# Command and data byte (int or single byte buffer)
+def frame(cmd, data):
+    tx[0] = cmd
+    tx[1] = data if isinstance(data, int) else data[0]
+    return tx_byte
+
+# Sprite data command with a sprite of the bank
+def sprite_frame(name):
+    tx[0] = CMD_SPRITE_DATA
+    tx_sprite[:] = BANK[name]
+    return tx_view
+
+# Play a schedule written by tb/scene.py (make scene-board),
+# every transaction at its clock cycles after next_frame
+def play_schedule(tt, spi, schedule, frames):
+    for _ in range(frames):
+        sync_frame()
+        start = time.ticks_us()
+
+        for cycles, data in schedule:
+            while time.ticks_diff(time.ticks_us(), start) < cycles // CYCLES_PER_US:
+                pass
+
+            send_frame(tt, spi, data)
+
+# Play an animation written by anim2bit.py, one frame per next_frame,
+# every sprite is read from flash right behind the command byte
+def play_animation(tt, spi, path, loops):
+    tx[0] = CMD_SPRITE_DATA
+
+    with open(path, 'rb') as animation:
+        for _ in range(loops):
+            animation.seek(0)
+            while animation.readinto(tx_sprite) == SPRITE_BYTES:
+                sync_frame()
+                send_frame(tt, spi, tx_view)
+
 def load_project(tt:DemoBoard):
     
     if not tt.shuttle.has('tt_um_top_mole99'):
@@ -261,7 +238,7 @@ def main():
     spi = PIOSPI(sm_id=0, pin_mosi=tt.pins.pin_uio1, pin_miso=tt.pins.pin_uio2, pin_sck=tt.pins.pin_uio3, cpha=True, cpol=False, freq=int(20e6))
 
     #tt.pins.pin_uio4.irq(trigger=Pin.IRQ_FALLING, handler=isr_line)
-    #tt.pins.pin_uio5.irq(trigger=Pin.IRQ_FALLING, handler=isr_frame)
+    tt.pins.pin_uio5.irq(trigger=Pin.IRQ_FALLING, handler=isr_frame)
 
     misc = int('00110', 2)
 
@@ -272,12 +249,14 @@ def main():
         print('2 - Set COLOR1')
         print('3 - Set COLOR2')
         print('4 - Set COLOR3')
-        print('5 - Set sprite to SPRITE_DRINK')
-        print('6 - Set sprite to SPRITE_HEART')
-        print('7 - Set sprite to SPRITE_SPIRAL')
-        print('8 - Set sprite to SPRITE_TT')
+        print('5 - Set sprite to drink')
+        print('6 - Set sprite to heart')
+        print('7 - Set sprite to spiral')
+        print('8 - Set sprite to tt')
         print('9 - Toggle sprite transparency')
         print('10 - Toggle sprite movement')
+        print('11 - Play scene for 10 seconds')
+        print('12 - Play animation.bin three times')
         
         input = sys.stdin.readline().rstrip()
         print(f'"{input}"')
@@ -290,51 +269,61 @@ def main():
             if background == '0':
                 misc &= ~0b11
                 misc |= 0
-                send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+                send_frame(tt, spi, frame(CMD_MISC, misc))
             elif background == '1':
                 misc &= ~0b11
                 misc |= 1
-                send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+                send_frame(tt, spi, frame(CMD_MISC, misc))
             elif background == '2':
                 misc &= ~0b11
                 misc |= 2
-                send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+                send_frame(tt, spi, frame(CMD_MISC, misc))
             elif background == '3':
                 misc &= ~0b11
                 misc |= 3
-                send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+                send_frame(tt, spi, frame(CMD_MISC, misc))
             else:
                 print(f'Unknown background: {background}')
         elif input == '1':
             color = choose_color()
             if color:
-                send_cmd(tt, spi, CMD_COLOR1, color)
+                send_frame(tt, spi, frame(CMD_COLOR1, color))
         elif input == '2':
             color = choose_color()
             if color:
-                send_cmd(tt, spi, CMD_COLOR2, color)
+                send_frame(tt, spi, frame(CMD_COLOR2, color))
         elif input == '3':
             color = choose_color()
             if color:
-                send_cmd(tt, spi, CMD_COLOR3, color)
+                send_frame(tt, spi, frame(CMD_COLOR3, color))
         elif input == '4':
             color = choose_color()
             if color:
-                send_cmd(tt, spi, CMD_COLOR4, color)
+                send_frame(tt, spi, frame(CMD_COLOR4, color))
         elif input == '5':
-            send_cmd(tt, spi, CMD_SPRITE_DATA, sprite2bytes(SPRITE_DRINK))
+            send_frame(tt, spi, sprite_frame('drink'))
         elif input == '6':
-            send_cmd(tt, spi, CMD_SPRITE_DATA, sprite2bytes(SPRITE_HEART))
+            send_frame(tt, spi, sprite_frame('heart'))
         elif input == '7':
-            send_cmd(tt, spi, CMD_SPRITE_DATA, sprite2bytes(SPRITE_SPIRAL))
+            send_frame(tt, spi, sprite_frame('spiral'))
         elif input == '8':
-            send_cmd(tt, spi, CMD_SPRITE_DATA, sprite2bytes(SPRITE_TT)) 
+            send_frame(tt, spi, sprite_frame('tt')) 
         elif input == '9':
             misc ^= 1<<3
-            send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+            send_frame(tt, spi, frame(CMD_MISC, misc))
         elif input == '10':
             misc ^= 1<<2
-            send_cmd(tt, spi, CMD_MISC, misc.to_bytes(1, 'little'))
+            send_frame(tt, spi, frame(CMD_MISC, misc))
+        elif input == '11':
+            # Generated by make scene-board, not part of the repository
+            try:
+                from .scene_schedule import SCHEDULE
+            except ImportError:
+                print('No scene_schedule.py, run make scene-board and push it')
+                continue
+            play_schedule(tt, spi, SCHEDULE, 600)
+        elif input == '12':
+            play_animation(tt, spi, DIR + '/animation.bin', 3)
         else:
             print(f'Unknown command: {input}')
 
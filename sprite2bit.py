@@ -1,33 +1,201 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Sprite compiler
+
+Converts the 12x12 images under sprites/ into the formats used by
+the design, the testbench and the bring-up board. A white pixel is
+a 0, every other pixel a 1. For every sprite <name> it writes:
+
+- <name>.sv:  reset initializer of sprite_data in sprite_data.sv
+- <name>.py:  SPRITE_<NAME> as list of rows, as in tb_cocotb.py
+- <name>.bin: the 18 bytes sent with the sprite data command
+
+sprites.py and sprites.h collect all sprites, the sprite bank
+(see bring-up/tt_um_top_mole99/sprite_bank.py) has all of them in
+one binary file for the testbench and the bring-up board. Sprites
+whose image is unchanged since the last run are not converted again,
+sprites of earlier runs are kept until their image is deleted.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
 from PIL import Image
-import glob, os
 
-for image_filename in glob.glob("sprites/*.png"):
-    print(f'Creating sprite from {image_filename}')
+# The bank format is defined next to the bring-up script,
+# which has to read it with MicroPython
+sys.path.insert(0, str(Path(__file__).parent / "bring-up" / "tt_um_top_mole99"))
+import sprite_bank
+
+SPRITE_WIDTH  = 12
+SPRITE_HEIGHT = 12
+
+MANIFEST = "manifest.json"
+
+BANK = "bring-up/tt_um_top_mole99/sprites.bank"
+
+# Below this many changed sprites a process pool costs more than it saves
+PARALLEL = 16
+
+def sprite_name(source):
+    return re.sub(r"\W", "_", Path(source).stem).lower()
+
+def load_sprite(source):
+    """The sprite as array of rows, 0 for white pixels"""
+
+    pixels = np.asarray(Image.open(source).convert("RGBA"))
+
+    height, width = pixels.shape[:2]
+    if (width, height) != (SPRITE_WIDTH, SPRITE_HEIGHT):
+        raise ValueError(f"{source} has {width}x{height} pixels, a sprite has {SPRITE_WIDTH}x{SPRITE_HEIGHT}")
+
+    return (pixels != 255).any(axis=-1).astype(np.uint8)
+
+def to_verilog(sprite):
+    return "".join(f"sprite_data[{SPRITE_WIDTH*(y+1)-1: <3}: {SPRITE_WIDTH*y: <3}] <= "
+                   f"{SPRITE_WIDTH}'b{''.join(str(bit) for bit in row[::-1])};\n"
+                   for y, row in enumerate(sprite))
+
+def to_python(name, sprite):
+    rows = "".join(f"    [{','.join(str(bit) for bit in row)}],\n" for row in sprite)
+    return f"SPRITE_{name.upper()} = [\n{rows}]\n"
+
+def to_bytes(sprite):
+    """Row by row, first pixel in the MSB, the order of the SPI transfer"""
+
+    return sprite_bank.to_bytes(sprite)
+
+def to_c(name, data):
+    return f"static const uint8_t sprite_{name}[{len(data)}] = {{ {', '.join(f'0x{byte:02x}' for byte in data)} }};\n"
+
+def convert(source, out_dir):
+    name = sprite_name(source)
+    sprite = load_sprite(source)
+
+    (out_dir / f"{name}.sv").write_text(to_verilog(sprite))
+    (out_dir / f"{name}.py").write_text(to_python(name, sprite))
+    (out_dir / f"{name}.bin").write_bytes(to_bytes(sprite))
 
-    file_name = os.path.splitext(os.path.basename(image_filename))[0]
-    img = Image.open('sprites/' + file_name + '.png')
-    pix = img.load()
+    return name
 
-    width, height = img.size
+# Manifest entry of a source, the contents are only
+# hashed if modification time or size changed
+def fingerprint(source, entry):
+    stat = source.stat()
+    if entry and entry["source"] == str(source) and \
+       entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        return entry
 
-    sprite_verilog = ""
-    sprite_python = "SPRITE = [\n"
+    return {
+        "source":   str(source),
+        "mtime_ns": stat.st_mtime_ns,
+        "size":     stat.st_size,
+        "sha256":   hashlib.sha256(source.read_bytes()).hexdigest(),
+    }
 
-    for y in range(height):
-        pixel_row = ''
-        for x in range(width):
-            if (pix[x, y] == (255, 255, 255, 255) or pix[x, y] == (255, 255, 255)):
-                pixel_row += '0'
+def outputs(out_dir, name):
+    return [out_dir / f"{name}{suffix}" for suffix in (".sv", ".py", ".bin")]
+
+def build(sources, out_dir, bank=None, force=False, jobs=None):
+    """Convert the changed sprites and write the collections,
+    returns the names of the converted sprites"""
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # A new compiler or bank format invalidates everything
+    compiler = hashlib.sha256(Path(__file__).read_bytes() + Path(sprite_bank.__file__).read_bytes()).hexdigest()
+
+    manifest_file = out_dir / MANIFEST
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+    if manifest.get("compiler") != compiler:
+        manifest = {}
+    entries = manifest.get("sprites", {})
+
+    names = {}
+    for source in sources:
+        name = sprite_name(source)
+        if name in names:
+            raise ValueError(f"{source} and {names[name]} are both sprite {name}")
+        names[name] = source
+
+    # Sprites built before stay in the build as long as their image
+    # exists, so converting a few sprites keeps all the others
+    removed = set()
+    for name, entry in entries.items():
+        if name not in names:
+            if Path(entry["source"]).exists():
+                names[name] = Path(entry["source"])
             else:
-                pixel_row += '1'
-                    
-        sprite_verilog += f"sprite_data[{width*(y+1)-1: <3}: {width*y: <3}] <= {width}'b{pixel_row[::-1]};\n"
-        sprite_python += f"    [{ ','.join(pixel_row) }],\n"
-    
-    sprite_python += "]"
-    
-    print("Sprite data Verilog:\n")
-    print(sprite_verilog)
-    
-    print("Sprite data Python:\n")
-    print(sprite_python)
+                removed.add(name)
+
+    fingerprints = {}
+    todo = []
+    for name, source in names.items():
+        entry = entries.get(name)
+        fingerprints[name] = fingerprint(source, entry)
+
+        if force or not entry or entry["sha256"] != fingerprints[name]["sha256"] or \
+           not all(output.exists() for output in outputs(out_dir, name)):
+            todo.append(source)
+
+    if len(todo) >= PARALLEL and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            converted = list(pool.map(convert, todo, [out_dir] * len(todo),
+                                      chunksize=max(1, len(todo) // (4 * (jobs or os.cpu_count())))))
+    else:
+        converted = [convert(source, out_dir) for source in todo]
+
+    # Sprites whose image is gone
+    for name in removed:
+        for output in outputs(out_dir, name):
+            output.unlink(missing_ok=True)
+
+    if converted or removed or not (out_dir / "sprites.py").exists() or not (out_dir / "sprites.h").exists():
+        python = ""
+        header = "#pragma once\n\n#include <stdint.h>\n\n"
+        for name in sorted(names):
+            python += (out_dir / f"{name}.py").read_text() + "\n"
+            header += to_c(name, (out_dir / f"{name}.bin").read_bytes())
+
+        (out_dir / "sprites.py").write_text(python)
+        (out_dir / "sprites.h").write_text(header)
+
+    if bank and (converted or removed or not bank.exists()):
+        bank.write_bytes(sprite_bank.pack([(name, (out_dir / f"{name}.bin").read_bytes())
+                                           for name in sorted(names)]))
+
+    manifest_file.write_text(json.dumps({"compiler": compiler, "sprites": fingerprints}, indent=1))
+
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert sprite images for the design, the testbench and the board")
+    parser.add_argument("sources", nargs="*", help="images, by default sprites/*.png")
+    parser.add_argument("-o", "--out", default="sprites/build", help="output directory")
+    parser.add_argument("-b", "--bank", default=BANK, help="sprite bank, empty to not write one")
+    parser.add_argument("-f", "--force", action="store_true", help="convert unchanged sprites too")
+    parser.add_argument("-j", "--jobs", type=int, help="parallel conversions")
+    args = parser.parse_args()
+
+    sources = [Path(source) for source in args.sources] or sorted(Path("sprites").glob("*.png"))
+
+    start = time.perf_counter()
+    converted = build(sources, Path(args.out), Path(args.bank) if args.bank else None,
+                      args.force, args.jobs)
+
+    print(f"Converted {len(converted)} of {len(sources)} sprites into {args.out} "
+          f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,9 @@
     - next_vertical/next_frame at the start
 */
 
-module top (
+module top #(
+    parameter PIXEL_SIZE = 8    // 8 for SVGA, 1, 2 or 4 for a scaled-down raster (simulation only)
+)(
     input  logic clk,
     input  logic reset_n,
 
@@ -34,25 +36,38 @@ module top (
     /*
         SVGA Timing for 800x600 60 Hz
         clock = 40 MHz or clock = 10 MHz
+        
+        With a smaller PIXEL_SIZE the resolution and
+        the porches shrink by the same factor
     */
+    
+    localparam SCALE    = 8 / PIXEL_SIZE;
 
-    localparam WIDTH    = 800;
-    localparam HEIGHT   = 600;
+    localparam WIDTH    = 100 * PIXEL_SIZE;
+    localparam HEIGHT   = 75 * PIXEL_SIZE;
     
-    localparam HFRONT   = 40;
-    localparam HSYNC    = 128;
-    localparam HBACK    = 88;
+    localparam HFRONT   = 40 / SCALE;
+    localparam HSYNC    = 128 / SCALE;
+    localparam HBACK    = 88 / SCALE;
 
     localparam VFRONT   = 1;
-    localparam VSYNC    = 4;
-    localparam VBACK    = 23;
+    localparam VSYNC    = SCALE > 4 ? 1 : 4 / SCALE;
+    localparam VBACK    = 23 / SCALE;
     
     localparam HTOTAL = WIDTH + HFRONT + HSYNC + HBACK;
     localparam VTOTAL = HEIGHT + VFRONT + VSYNC + VBACK;
     
-    // Downscaling by factor of 8, i.e. one pixel is 8x8
-    localparam WIDTH_SMALL  = WIDTH / 8;
-    localparam HEIGHT_SMALL = HEIGHT / 8;
+    // Downscaling by PIXEL_SIZE, i.e. one pixel is 8x8 for SVGA
+    localparam WIDTH_SMALL  = WIDTH / PIXEL_SIZE;
+    localparam HEIGHT_SMALL = HEIGHT / PIXEL_SIZE;
+    
+    localparam PIXEL_SHIFT = $clog2(PIXEL_SIZE);
+    localparam bit [2:0] PIXEL_MASK = 3'(PIXEL_SIZE - 1);
+
+    // PIXEL_MASK and the scaled porches only work for powers of two up to 8
+    if (PIXEL_SIZE != 1 && PIXEL_SIZE != 2 && PIXEL_SIZE != 4 && PIXEL_SIZE != 8) begin : check_pixel_size
+        $fatal(1, "PIXEL_SIZE must be 1, 2, 4 or 8, not %0d", PIXEL_SIZE);
+    end
     
     /*
         Global Parameters
@@ -191,11 +206,11 @@ module top (
         .sprite_y       (sprite_y)
     );
     
-    logic signed [$clog2(HTOTAL) - 3 : 0] counter_h_small;
-    logic signed [$clog2(VTOTAL) - 3 : 0] counter_v_small;
+    logic signed [$clog2(HTOTAL) - PIXEL_SHIFT : 0] counter_h_small;
+    logic signed [$clog2(VTOTAL) - PIXEL_SHIFT : 0] counter_v_small;
 
-    assign counter_h_small = counter_h[$clog2(HTOTAL) : 3];
-    assign counter_v_small = counter_v[$clog2(VTOTAL) : 3];
+    assign counter_h_small = counter_h[$clog2(HTOTAL) : PIXEL_SHIFT];
+    assign counter_v_small = counter_v[$clog2(VTOTAL) : PIXEL_SHIFT];
 
     /*
         Sprite Visibility
@@ -236,8 +251,8 @@ module top (
     logic start_big_line;
     logic end_big_pixel;
     
-    assign start_big_line = counter_v[2:0] == 3'b000;
-    assign end_big_pixel   = (inc_1_or_4 == 1'b0) ? counter_h[2:0] == 3'b111 : counter_h[2] == 1'b1;
+    assign start_big_line = (counter_v[2:0] & PIXEL_MASK) == 3'b000;
+    assign end_big_pixel   = (inc_1_or_4 == 1'b0) ? (counter_h[2:0] & PIXEL_MASK) == PIXEL_MASK : counter_h[2] == 1'b1;
     
     sprite_access #(
         .WIDTH  (SPRITE_WIDTH)
@@ -268,7 +283,7 @@ module top (
         end else begin
             // Only ever assign at next_frame
             // to prevent glitches
-            if (next_vertical && counter_v[2:0] == 3'b111) begin
+            if (next_vertical && (counter_v[2:0] & PIXEL_MASK) == PIXEL_MASK) begin
                 bg_sel <= misc[1:0];
             end
         end
@@ -366,5 +381,26 @@ module top (
         .misc       (misc)
     );
 
+`ifdef COCOTB
+
+    /*
+        Frame Dump
+    */
+
+    frame_capture #(
+        .WIDTH      (WIDTH),
+        .HEIGHT     (HEIGHT),
+        .PIXEL_SIZE (PIXEL_SIZE)
+    ) frame_capture_inst (
+        .clk        (clk),
+        .reset_n    (reset_n),
+        .blank      (hblank || vblank),
+        .next_line  (next_vertical),
+        .next_frame (next_frame),
+        .reduced    (inc_1_or_4),
+        .rrggbb     (rrggbb)
+    );
+
+`endif
 
 endmodule
@@ -0,0 +1,193 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import json
+import time
+import subprocess
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.triggers import Timer, FallingEdge
+from cocotb.utils import get_sim_time
+
+from cocotbext.spi import SpiBus, SpiConfig, SpiMaster
+
+import golden
+from spi_driver import SpiDriver
+from tb_cocotb import (
+    CLK_PERIOD_NS, CMD_COLOR1, CMD_SPRITE_DATA, COLOR1, SPRITE_TT, PIXEL_SIZE,
+    FRAME_DUMP_PLUSARG, FRAME_DUMP_FILE,
+    reset_dut, draw_frame, draw_blocks, draw_frame_software, compare_frames,
+    spi_send_cmd, sprite2bytes, backdoor_write, drain_artifacts, build_design, run_testcase
+)
+
+# Amount of work per measurement
+BENCH_CYCLES  = 200000
+BENCH_FRAMES  = 2
+BENCH_SPI     = 10
+BENCH_RENDERS = 100
+
+BENCH_RESULTS = "bench.json"
+
+CAPTURE_MODES = {
+    "python": [],
+    "dump":   [f"+{FRAME_DUMP_PLUSARG}={FRAME_DUMP_FILE}"],
+}
+
+# Measure wall and simulation time of a coroutine
+async def measure(coro, repeat):
+    start_wall = time.perf_counter()
+    start_sim = get_sim_time("ns")
+
+    for _ in range(repeat):
+        await coro()
+
+    return {
+        "wall_s":   (time.perf_counter() - start_wall) / repeat,
+        "sim_ns":   (get_sim_time("ns") - start_sim) / repeat,
+    }
+
+# Measure wall time of a function
+def measure_sync(func, repeat):
+    start_wall = time.perf_counter()
+
+    for _ in range(repeat):
+        func()
+
+    return {"wall_s": (time.perf_counter() - start_wall) / repeat}
+
+@cocotb.test()
+@drain_artifacts
+async def bench(dut):
+    """This test measures the simulation throughput
+       and writes the results to bench.json"""
+
+    results = {}
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi_bus = SpiBus.from_prefix(dut, "spi")
+
+    spi_config = SpiConfig(
+        word_width = 8,
+        sclk_freq  = 2e6,
+        cpol       = False,
+        cpha       = True,
+        msb_first  = True,
+        frame_spacing_ns = 500
+    )
+
+    spi_master = SpiMaster(spi_bus, spi_config)
+    spi_driver = SpiDriver(dut, CLK_PERIOD_NS)
+
+    await reset_dut(dut.reset_n, 50)
+
+    # Simulation speed with only the clock coroutine in the loop
+    start_wall = time.perf_counter()
+    await Timer(BENCH_CYCLES * CLK_PERIOD_NS, units="ns")
+    results["cycles_per_second"] = BENCH_CYCLES / (time.perf_counter() - start_wall)
+
+    # SPI transactions
+    results["spi_register_write"] = await measure(
+        lambda: spi_send_cmd(dut, spi_master, [CMD_COLOR1], [COLOR1]), BENCH_SPI)
+    results["spi_sprite_burst"] = await measure(
+        lambda: spi_send_cmd(dut, spi_master, [CMD_SPRITE_DATA], sprite2bytes(SPRITE_TT), burst=True), BENCH_SPI)
+
+    # The same with the in-repo SPI driver at clk/4
+    results["spi_driver_register_write"] = await measure(
+        lambda: spi_driver.write(CMD_COLOR1, [COLOR1]), BENCH_SPI)
+    results["spi_driver_sprite_burst"] = await measure(
+        lambda: spi_driver.write(CMD_SPRITE_DATA, sprite2bytes(SPRITE_TT)), BENCH_SPI)
+
+    # The same through the backdoor
+    results["backdoor_write"] = await measure(
+        lambda: backdoor_write(dut, colors=(COLOR1, None, None, None), sprite=SPRITE_TT), BENCH_SPI)
+
+    # Frame capture
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    frame = None
+
+    async def capture():
+        nonlocal frame
+        frame = await draw_frame(dut)
+
+    results["frame_capture"] = await measure(capture, BENCH_FRAMES)
+    results["frame_capture"]["cycles_per_second"] = \
+        results["frame_capture"]["sim_ns"] / CLK_PERIOD_NS / results["frame_capture"]["wall_s"]
+
+    # One sample per big pixel, needs a solid background
+    await backdoor_write(dut, misc=0)
+
+    blocks = None
+
+    async def capture_blocks():
+        nonlocal blocks
+        blocks = await draw_blocks(dut)
+
+    results["block_capture"] = await measure(capture_blocks, BENCH_FRAMES)
+    results["block_capture"]["cycles_per_second"] = \
+        results["block_capture"]["sim_ns"] / CLK_PERIOD_NS / results["block_capture"]["wall_s"]
+
+    # Software reference
+    gold = draw_frame_software()
+    gold_blocks = golden.to_blocks(gold, PIXEL_SIZE)
+    results["golden_render"] = measure_sync(draw_frame_software, BENCH_RENDERS)
+    results["compare"] = measure_sync(lambda: compare_frames(frame, gold), BENCH_RENDERS)
+    results["block_compare"] = measure_sync(lambda: compare_frames(blocks, gold_blocks), BENCH_RENDERS)
+
+    Path(BENCH_RESULTS).write_text(json.dumps(results, indent=2))
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True,
+                                       cwd=Path(__file__).resolve().parent).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_runner():
+    hdl_toplevel_lang = os.getenv("HDL_TOPLEVEL_LANG", "verilog")
+    sims = os.getenv("BENCH_SIMS", "icarus,verilator").split(",")
+    threads = int(os.getenv("THREADS", 1)) # verilator only
+    captures = os.getenv("BENCH_CAPTURE", ",".join(CAPTURE_MODES)).split(",")
+
+    sim_dir = Path("sim_build").resolve()
+    history = Path(os.getenv("BENCH_HISTORY", sim_dir / "bench_history.jsonl"))
+    cache_dir = Path(os.getenv("BUILD_CACHE", sim_dir / "cache")).resolve()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    report = {
+        "timestamp":    datetime.now(timezone.utc).isoformat(),
+        "revision":     git_revision(),
+        "results":      [],
+    }
+
+    for sim in sims:
+        build_dir = build_design(sim, cache_dir, threads=threads)
+
+        for capture in captures:
+            test_dir = sim_dir / "bench" / f"{sim}-{capture}"
+
+            run_testcase(sim, hdl_toplevel_lang, build_dir, test_dir, "bench",
+                         CAPTURE_MODES[capture], test_module="bench_cocotb")
+
+            results = json.loads((test_dir / BENCH_RESULTS).read_text())
+            report["results"].append({"sim": sim, "threads": threads, "capture": capture, **results})
+
+    print(json.dumps(report, indent=2))
+
+    # One line per run to track regressions over time
+    with history.open("a") as f:
+        f.write(json.dumps(report) + "\n")
+
+    return report
+
+
+if __name__ == "__main__":
+    bench_runner()
@@ -0,0 +1,128 @@
+// SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+// SPDX-License-Identifier: Apache-2.0
+
+`timescale 1ns/1ps
+`default_nettype none
+
+/*
+    Simulation only: dumps the active area of every frame
+    as raw bytes, one 6-bit color code per pixel.
+    Frame n starts at byte offset n*WIDTH*HEIGHT, the file
+    is positioned there at every next_frame, a frame
+    interrupted by reset is overwritten by the next one.
+    Every line is flushed to the file once it is complete.
+    In the reduced frequency mode every sample is written
+    as 4 pixels.
+
+    Enabled with +FRAME_DUMP=<filename>
+
+    Independent of the dump, every pixel is compared with
+    the first pixel of its PIXEL_SIZE x PIXEL_SIZE block.
+    nonuniform counts the pixels of the current frame that
+    differ, the first one is at first_x, first_y. The counts
+    are valid from the end of the active area until the first
+    pixel of the next frame.
+*/
+
+module frame_capture #(
+    parameter WIDTH,            // active pixels per line
+    parameter HEIGHT,           // active lines per frame
+    parameter PIXEL_SIZE        // size of a big pixel
+)(
+    input  logic clk,           // clock
+    input  logic reset_n,       // reset active low
+    input  logic blank,         // 1'b1 outside of the active area
+    input  logic next_line,     // line was completed
+    input  logic next_frame,    // frame was completed
+    input  logic reduced,       // reduced frequency mode, 4 pixels per sample
+    input  logic [5:0] rrggbb   // current pixel
+);
+
+    integer fd = 0;
+    integer frame_index = 0;
+    integer status;
+    string filename;
+
+    initial begin
+        if ($value$plusargs("FRAME_DUMP=%s", filename)) begin
+            fd = $fopen(filename, "wb");
+        end
+    end
+
+    // Start the current frame again
+    always @(negedge reset_n) begin
+        if (fd != 0) begin
+            status = $fseek(fd, frame_index * WIDTH * HEIGHT, 0);
+        end
+    end
+
+    // Block uniformity
+
+    logic [5:0] block_color [WIDTH/PIXEL_SIZE];
+    integer x = 0;
+    integer y = 0;
+    integer nonuniform = 0;
+    integer first_x = 0;
+    integer first_y = 0;
+
+    always @(posedge clk) begin
+        if (!reset_n) begin
+            x <= 0;
+            y <= 0;
+        end else begin
+            if (!blank && x < WIDTH) begin
+                if (x == 0 && y == 0) begin
+                    nonuniform <= 0;
+                end
+
+                if (x % PIXEL_SIZE == 0 && y % PIXEL_SIZE == 0) begin
+                    block_color[x / PIXEL_SIZE] <= rrggbb;
+                end else if (rrggbb != block_color[x / PIXEL_SIZE]) begin
+                    if (nonuniform == 0) begin
+                        first_x <= x;
+                        first_y <= y;
+                    end
+                    nonuniform <= nonuniform + 1;
+                end
+
+                x <= x + (reduced ? 4 : 1);
+            end
+
+            if (next_line) begin
+                x <= 0;
+                if (!blank) begin
+                    y <= y + 1;
+                end
+            end
+
+            if (next_frame) begin
+                y <= 0;
+            end
+        end
+    end
+
+    always @(posedge clk) begin
+        if (fd != 0 && reset_n) begin
+            if (!blank && x < WIDTH) begin
+                if (reduced) begin
+                    $fwrite(fd, "%c%c%c%c", rrggbb, rrggbb, rrggbb, rrggbb);
+                end else begin
+                    $fwrite(fd, "%c", rrggbb);
+                end
+            end
+
+            // Make the line visible to the testbench
+            if (next_line) begin
+                $fflush(fd);
+            end
+
+            // Start of the next frame, independent of
+            // how many bytes were written for this one
+            if (next_frame) begin
+                frame_index <= frame_index + 1;
+                status = $fseek(fd, (frame_index + 1) * WIDTH * HEIGHT, 0);
+            end
+        end
+    end
+
+endmodule
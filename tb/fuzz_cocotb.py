@@ -0,0 +1,326 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Randomized SPI command streams checked against the reference model
+
+A seed expands into a list of transactions (position, data, nbits):
+data is sent with CS low starting in the state at position, counted
+in clock cycles from the first state of the first captured frame,
+and nbits ends the transaction early. The stream covers all eight
+commands, chained commands, partial sprite bursts, transactions
+aborted by CS in the middle of a byte and starts anywhere in the
+active area and in the blanking. Positions are planned for the
+normal timing, frames in the reduced frequency mode are shorter
+and more of them are captured until all transactions are sent.
+
+Every line of the frames is compared with the reference model,
+running in lockstep, and all registers at the end. Failing seeds are
+shrunk to a minimal list of transactions that still fails.
+"""
+
+import os
+import json
+import math
+import random
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.triggers import Timer, FallingEdge, ReadOnly
+from cocotb.utils import get_sim_time
+
+from spi_driver import SpiDriver
+from tb_cocotb import (
+    HEIGHT, VBACK, CLK_PERIOD_NS, CMD_SPRITE_DATA, SPRITE_WIDTH, SPRITE_HEIGHT,
+    reset_dut, draw_frame, new_model, new_raster, start_model,
+    state_handles, resolve_int, drain_artifacts, build_design, run_testcase
+)
+
+FUZZ_OPS = "fuzz_ops.json"
+FUZZ_ERROR = "fuzz_error.txt"
+
+# Bus timing of the fuzzer, the fastest SpiDriver allows
+HALF_PERIOD = 2
+GAP = 4
+
+SPRITE_BYTES = SPRITE_WIDTH * SPRITE_HEIGHT // 8
+
+# Candidates drawn for a transaction before it is left out
+RETRIES = 20
+
+def transfer_cycles(nbits):
+    return (2 * nbits + 1) * HALF_PERIOD + GAP
+
+def stream_bits(data, nbits):
+    return [(byte >> bit) & 1 for byte in data for bit in range(7, -1, -1)][:nbits]
+
+def random_transaction(rng):
+    data = []
+
+    # Garbage
+    if rng.random() < 0.1:
+        data = [rng.randrange(256) for _ in range(rng.randint(1, 4))]
+
+    # One or more commands, sprite data ends a transaction
+    else:
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            cmd = rng.randrange(8)
+            nbytes = SPRITE_BYTES if cmd == CMD_SPRITE_DATA else 1
+
+            data += [cmd] + [rng.randrange(256) for _ in range(nbytes)]
+            if cmd == CMD_SPRITE_DATA:
+                break
+
+    # Partial bursts and CS aborts
+    nbits = 8 * len(data)
+    if rng.random() < 0.25:
+        nbits = rng.randrange(nbits)
+
+    return bytes(data), nbits
+
+def random_start(rng, raster, earliest, spacing):
+    where = rng.random()
+
+    # Right after the previous transaction
+    if where < 0.2:
+        return earliest
+
+    start = earliest + rng.randrange(2 * spacing)
+
+    # Into the horizontal blanking
+    if where < 0.4:
+        line = start // raster.htotal
+        start = line * raster.htotal + rng.randrange(raster.hblank)
+        if start < earliest:
+            start += raster.htotal
+
+    # Into the vertical blanking of the next frame
+    elif where < 0.5:
+        start = (start // raster.frame_cycles + 1) * raster.frame_cycles + \
+                rng.randrange(raster.vblank * raster.htotal)
+
+    return start
+
+# Transactions of a seed over frames frames
+def generate(seed, count, frames):
+    rng = random.Random(seed)
+    raster = new_raster()
+
+    # From the line after the one the test starts in to
+    # the start of the last line of the last frame
+    first = raster.line_start(-VBACK + 1)
+    last = (frames - 1) * raster.frame_cycles + raster.line_start(HEIGHT - 1)
+    spacing = max(1, (last - first) // count)
+
+    ops = []
+    earliest = first
+
+    for _ in range(count):
+        for _ in range(RETRIES):
+            data, nbits = random_transaction(rng)
+            start = random_start(rng, raster, earliest, spacing)
+
+            op = (start, data, nbits)
+            if start + transfer_cycles(nbits) <= last:
+                ops.append(op)
+                earliest = start + transfer_cycles(nbits) + 1
+                break
+
+    return ops
+
+def save_ops(filename, ops, frames):
+    Path(filename).write_text(json.dumps({
+        "frames": frames,
+        "ops": [[position, data.hex(), nbits] for position, data, nbits in ops],
+    }, indent=1))
+
+def load_ops(filename):
+    content = json.loads(Path(filename).read_text())
+    return [(position, bytes.fromhex(data), nbits) for position, data, nbits in content["ops"]], \
+           content["frames"]
+
+# Send every transaction in the state at its position,
+# origin is the position of the first state of the model
+# Returns at the start of the vertical sync after the last one
+async def play_ops(dut, spi, model, origin, ops):
+    period = CLK_PERIOD_NS * 1000
+
+    for position, data, nbits in ops:
+        # Wake up at the clock edge into the state,
+        # the transaction starts at the falling edge
+        delay = model.origin + (position - origin) * period - round(get_sim_time("ps"))
+        await Timer(delay, units="ps")
+        await spi.transfer(data, nbits)
+
+    await FallingEdge(dut.vsync)
+
+@cocotb.test()
+@drain_artifacts
+async def fuzz(dut):
+    """This test plays the random SPI command stream in FUZZ_OPS,
+       compares every line with the reference model and all
+       registers at the end"""
+
+    ops, frames = load_ops(os.environ.get("FUZZ_OPS", FUZZ_OPS))
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi = SpiDriver(dut, CLK_PERIOD_NS, HALF_PERIOD, GAP)
+
+    await reset_dut(dut.reset_n, 50)
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    model = new_model()
+    await start_model(dut, model)
+
+    origin = new_raster().position(dut.timing_ver.counter.value.signed_integer,
+                                   dut.timing_hor.counter.value.signed_integer)
+    assert not ops or ops[0][0] > origin, f"First transaction at {ops[0][0]} before the start at {origin}"
+
+    try:
+        play = cocotb.start_soon(play_ops(dut, spi, model, origin, ops))
+
+        drawn = 0
+        while drawn < frames or not play.done():
+            await draw_frame(dut, model=model)
+            drawn += 1
+
+        # The bus is idle and nothing changes in the blanking,
+        # the model stops at the start of the current line
+        await ReadOnly()
+        while model.v != dut.timing_ver.counter.value.signed_integer:
+            model.step_line()
+
+        mismatches = [f"{name} is {resolve_int(handle):#x}, expected {getattr(model, name):#x}"
+                      for name, handle in state_handles(dut).items()
+                      if resolve_int(handle) != getattr(model, name)]
+        assert not mismatches, ", ".join(mismatches)
+
+    except Exception as error:
+        Path(FUZZ_ERROR).write_text(f"{type(error).__name__}: {error}")
+        raise
+
+# Run a list of transactions, returns why it failed or None
+def run_ops(sim, hdl_toplevel_lang, build_dir, test_dir, ops, frames):
+    test_dir.mkdir(parents=True, exist_ok=True)
+    save_ops(test_dir / FUZZ_OPS, ops, frames)
+
+    error = test_dir / FUZZ_ERROR
+    error.unlink(missing_ok=True)
+
+    try:
+        run_testcase(sim, hdl_toplevel_lang, build_dir, test_dir, "fuzz", [],
+                     test_module="fuzz_cocotb", extra_env={"FUZZ_OPS": str(test_dir / FUZZ_OPS)})
+    except Exception as exception:
+        return str(exception)
+
+    if error.exists():
+        return error.read_text()
+
+    results = ET.parse(test_dir / "results.xml").getroot()
+    if any(testcase.find("failure") is not None or testcase.find("error") is not None
+           for testcase in results.iter("testcase")):
+        return f"Failed, see {test_dir / 'results.xml'}"
+
+    return None
+
+# Delta debugging: a subset of ops for which fails()
+# holds and that no longer does without any of its ops
+def shrink(ops, fails):
+    n = 2
+    while len(ops) >= 2:
+        size = math.ceil(len(ops) / n)
+        chunks = [ops[i:i+size] for i in range(0, len(ops), size)]
+
+        for index, chunk in enumerate(chunks):
+            complement = [op for other in chunks[:index] + chunks[index+1:] for op in other]
+            if fails(chunk):
+                ops, n = chunk, 2
+                break
+            if len(chunks) > 2 and fails(complement):
+                ops, n = complement, max(n - 1, 2)
+                break
+        else:
+            if n >= len(ops):
+                break
+            n = min(2 * n, len(ops))
+
+    return ops
+
+# Run one seed and shrink it if it fails,
+# returns (error, reproducer) or None
+def fuzz_seed(sim, hdl_toplevel_lang, build_dir, test_dir, seed, count, frames):
+    ops = generate(seed, count, frames)
+
+    error = run_ops(sim, hdl_toplevel_lang, build_dir, test_dir, ops, frames)
+    if error is None:
+        return None
+
+    def fails(subset):
+        return run_ops(sim, hdl_toplevel_lang, build_dir, test_dir / "shrink", subset, frames) is not None
+
+    minimal = shrink(ops, fails)
+
+    reproducer = test_dir / "reproducer.json"
+    save_ops(reproducer, minimal, frames)
+
+    return error, reproducer
+
+def parse_seeds(seeds):
+    result = []
+    for part in seeds.split(","):
+        first, _, last = part.partition("-")
+        result += range(int(first), int(last or first) + 1)
+    return result
+
+# Run many seeds in parallel, one simulator process per
+# seed, and report a minimal reproducer for every failure
+def fuzz_runner():
+    hdl_toplevel_lang = os.getenv("HDL_TOPLEVEL_LANG", "verilog")
+    sim = os.getenv("SIM", "icarus") # "verilator" "icarus"
+    workers = int(os.getenv("WORKERS", os.cpu_count()))
+    threads = int(os.getenv("THREADS", 1)) # verilator only
+
+    seeds = parse_seeds(os.getenv("FUZZ_SEEDS", "0-15"))
+    count = int(os.getenv("FUZZ_COUNT", 32))
+    frames = int(os.getenv("FUZZ_FRAMES", 2))
+    replay = os.getenv("FUZZ_REPLAY")
+
+    sim_dir = Path("sim_build").resolve()
+    cache_dir = Path(os.getenv("BUILD_CACHE", sim_dir / "cache")).resolve()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    build_dir = build_design(sim, cache_dir, threads=threads)
+
+    # Run a saved reproducer instead of the seeds
+    if replay:
+        ops, frames = load_ops(replay)
+        error = run_ops(sim, hdl_toplevel_lang, build_dir, sim_dir / "fuzz" / "replay", ops, frames)
+        assert error is None, error
+        return
+
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(seeds)))) as pool:
+        futures = {seed: pool.submit(fuzz_seed, sim, hdl_toplevel_lang, build_dir,
+                                     sim_dir / "fuzz" / str(seed), seed, count, frames)
+                   for seed in seeds}
+        results = {seed: future.result() for seed, future in futures.items()}
+
+    failures = {seed: result for seed, result in results.items() if result}
+    for seed, (error, reproducer) in failures.items():
+        ops, _ = load_ops(reproducer)
+        print(f"Seed {seed}: {error}")
+        print(f"  {len(ops)} transactions in {reproducer}, run it with FUZZ_REPLAY={reproducer}")
+
+    print(f"{len(seeds) - len(failures)} of {len(seeds)} seeds passed")
+    assert not failures, f"Failing seeds: {', '.join(str(seed) for seed in failures)}"
+
+
+if __name__ == "__main__":
+    fuzz_runner()
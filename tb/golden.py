@@ -0,0 +1,167 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Vectorized software reference of the video path
+
+All functions operate on whole frames as NumPy arrays of
+6-bit rrggbb color codes, exactly what the design drives
+on its rrggbb output during the active area.
+"""
+
+import numpy as np
+
+# 2-bit to 8-bit channel expansion
+CHANNEL_LUT = np.array([0x00, 0x7F, 0x80, 0xFF], dtype=np.uint8)
+
+# RGB of all 64 color codes, frames only hold the codes
+# and the palette is applied when an image is written
+_CODES = np.arange(64, dtype=np.uint8)
+PALETTE = np.stack((CHANNEL_LUT[(_CODES >> 4) & 0x3],
+                    CHANNEL_LUT[(_CODES >> 2) & 0x3],
+                    CHANNEL_LUT[_CODES & 0x3]), axis=-1)
+
+def frame_time(frame_index):
+    """Value of cur_time in top.sv after frame_index completed frames"""
+
+    # cur_time counts up to 255 and back down to 0
+    t = frame_index % 510
+    return t if t <= 255 else 510 - t
+
+def move_sprite(position, direction, turn):
+    """One step of sprite_movement.sv along one axis
+
+    turn is the position at which the sprite reverses,
+    returns the new position and direction.
+    """
+
+    if not direction:
+        return (position + 1) & 0xFF, 1 if position == turn else direction
+    return (position - 1) & 0xFF, 0 if position == 1 else direction
+
+def sprite_trajectory(sprite_x, sprite_y, x_dir, y_dir, divider, width_small, height_small,
+                      sprite_width=12, sprite_height=12):
+    """Sprite position of sprite_movement.sv with movement enabled
+
+    Yields (sprite_x, sprite_y) for the current frame and then for
+    every following frame. divider is its value before the next
+    frame boundary, the sprite moves at every second boundary.
+    """
+
+    while True:
+        yield sprite_x, sprite_y
+
+        if divider:
+            sprite_x, x_dir = move_sprite(sprite_x, x_dir, width_small - sprite_width - 1)
+            sprite_y, y_dir = move_sprite(sprite_y, y_dir, height_small - sprite_height - 1)
+
+        divider ^= 1
+
+def background(bg_sel, cur_time, colors, h, v):
+    """Background color of background.sv at the raster positions h, v
+
+    h and v are broadcast against each other.
+    """
+
+    h = np.asarray(h, dtype=np.int32)
+    v = np.asarray(v, dtype=np.int32)
+
+    # Solid
+    if bg_sel == 0:
+        return np.full(np.broadcast(h, v).shape, colors[2], dtype=np.uint8)
+
+    # Funky: (counter_h[7:2] ^ counter_v[7:2]) + cur_time[7:2]
+    if bg_sel == 1:
+        funky = (((h >> 2) & 0x3F) ^ ((v >> 2) & 0x3F)) + (cur_time >> 2)
+        return np.broadcast_to(funky & 0x3F, np.broadcast(h, v).shape).astype(np.uint8)
+
+    palette = np.array(colors, dtype=np.uint8)
+
+    # Diagonal stripes: tmp[7:6] with tmp = counter_h + counter_v + cur_time
+    if bg_sel == 2:
+        return palette[((h + v + cur_time) >> 6) & 0x3]
+
+    # Horizontal stripes: tmp2[6:5] with tmp2 = counter_v + cur_time
+    stripes = palette[((v + cur_time) >> 5) & 0x3]
+    return np.broadcast_to(stripes, np.broadcast(h, v).shape).copy()
+
+def render_background(bg_sel, cur_time, colors, width, height):
+    """Render one of the four backgrounds of background.sv"""
+
+    h = np.arange(width, dtype=np.int32)[np.newaxis, :]
+    v = np.arange(height, dtype=np.int32)[:, np.newaxis]
+
+    return background(bg_sel, cur_time, colors, h, v)
+
+def render_sprite(frame, sprite, sprite_x, sprite_y, color1, color2, enable_sprite_bg, pixel_size):
+    """Draw the sprite on top of frame, in place
+
+    sprite_x and sprite_y are in units of big pixels. A sprite that
+    leaves the screen is clipped, the desynchronized sprite shift
+    register the design shows in that case is not reproduced here.
+    """
+
+    height, width = frame.shape
+
+    sprite = np.asarray(sprite, dtype=bool)
+    sprite_height, sprite_width = sprite.shape
+
+    # Clip the sprite against the visible area
+    visible = sprite[:max(0, min(sprite_height, height // pixel_size - sprite_y)),
+                     :max(0, min(sprite_width,  width  // pixel_size - sprite_x))]
+
+    if visible.size == 0:
+        return frame
+
+    mask = visible.repeat(pixel_size, axis=0).repeat(pixel_size, axis=1)
+
+    y0 = sprite_y * pixel_size
+    x0 = sprite_x * pixel_size
+    window = frame[y0:y0+mask.shape[0], x0:x0+mask.shape[1]]
+
+    window[mask] = color1
+    if enable_sprite_bg:
+        window[~mask] = color2
+
+    return frame
+
+def render_frame(sprite, sprite_x, sprite_y, colors, bg_sel, enable_sprite_bg, cur_time,
+                 width, height, pixel_size):
+    """Render a complete frame of 6-bit color codes
+
+    colors is the tuple (color1, color2, color3, color4).
+    """
+
+    frame = render_background(bg_sel, cur_time, colors, width, height)
+    return render_sprite(frame, sprite, sprite_x, sprite_y,
+                         colors[0], colors[1], enable_sprite_bg, pixel_size)
+
+def render_scene(sprites, bands, colors, enable_sprite_bg, cur_time, width, height, pixel_size):
+    """Render a frame of several sprites on background bands
+
+    sprites is a list of (sprite, sprite_x, sprite_y) and bands a list
+    of (first big line, bg_sel), see scene.plan().
+    """
+
+    frame = np.empty((height, width), dtype=np.uint8)
+    h = np.arange(width, dtype=np.int32)[np.newaxis, :]
+
+    for (first, bg_sel), (last, _) in zip(bands, bands[1:] + [(height // pixel_size, None)]):
+        v = np.arange(first * pixel_size, last * pixel_size, dtype=np.int32)[:, np.newaxis]
+        frame[v[:, 0]] = background(bg_sel, cur_time, colors, h, v)
+
+    for sprite, sprite_x, sprite_y in sprites:
+        render_sprite(frame, sprite, sprite_x, sprite_y,
+                      colors[0], colors[1], enable_sprite_bg, pixel_size)
+
+    return frame
+
+def to_blocks(frame, pixel_size):
+    """One color code per big pixel, the first pixel of every block"""
+
+    return np.ascontiguousarray(frame[::pixel_size, ::pixel_size])
+
+def to_rgb(frame):
+    """Expand a frame of 6-bit color codes to 8-bit RGB"""
+
+    return PALETTE[np.asarray(frame, dtype=np.uint8) & 0x3F]
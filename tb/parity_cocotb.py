@@ -0,0 +1,106 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+from pathlib import Path
+import numpy as np
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.triggers import FallingEdge
+
+from cocotbext.spi import SpiBus, SpiConfig, SpiMaster
+
+from tb_cocotb import (
+    WIDTH, HEIGHT, CLK_PERIOD_NS, CMD_SPRITE_DATA, CMD_COLOR1, CMD_SPRITE_X, CMD_SPRITE_Y, CMD_MISC,
+    SPRITE_HEART, reset_dut, draw_frame, spi_send_cmd, sprite2bytes, drain_artifacts,
+    build_design, run_testcase
+)
+
+PARITY_FRAMES = 3
+PARITY_RESULTS = "parity.npy"
+
+@cocotb.test()
+@drain_artifacts
+async def parity(dut):
+    """This test runs a short scenario with sprite
+       movement and an animated background and saves
+       the frames to compare them between simulators"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi_bus = SpiBus.from_prefix(dut, "spi")
+
+    spi_config = SpiConfig(
+        word_width = 8,
+        sclk_freq  = 2e6,
+        cpol       = False,
+        cpha       = True,
+        msb_first  = True,
+        frame_spacing_ns = 500
+    )
+
+    spi_master = SpiMaster(spi_bus, spi_config)
+
+    await reset_dut(dut.reset_n, 50)
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    task_draw_frame = await cocotb.start(draw_frame(dut))
+
+    # Sprite movement enabled, funky background
+    await spi_send_cmd(dut, spi_master, [CMD_SPRITE_X], [40])
+    await spi_send_cmd(dut, spi_master, [CMD_SPRITE_Y], [30])
+    await spi_send_cmd(dut, spi_master, [CMD_SPRITE_DATA], sprite2bytes(SPRITE_HEART), burst=True)
+    await spi_send_cmd(dut, spi_master, [CMD_COLOR1], [0x30])
+    await spi_send_cmd(dut, spi_master, [CMD_MISC], [1 << 3 | 1 << 2 | 1])
+
+    frames = np.zeros((PARITY_FRAMES, HEIGHT, WIDTH), dtype=np.uint8)
+    frames[0] = await task_draw_frame.join()
+
+    for i in range(1, PARITY_FRAMES):
+        frames[i] = await draw_frame(dut)
+
+    np.save(PARITY_RESULTS, frames)
+
+# Run the parity scenario on both simulators
+# and check that the frames are identical
+def test_parity():
+    hdl_toplevel_lang = os.getenv("HDL_TOPLEVEL_LANG", "verilog")
+    sims = os.getenv("PARITY_SIMS", "icarus,verilator").split(",")
+    threads = int(os.getenv("THREADS", 1)) # verilator only
+
+    sim_dir = Path("sim_build").resolve()
+    cache_dir = Path(os.getenv("BUILD_CACHE", sim_dir / "cache")).resolve()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    frames = {}
+
+    for sim in sims:
+        build_dir = build_design(sim, cache_dir, threads=threads)
+        test_dir = sim_dir / "parity" / sim
+
+        run_testcase(sim, hdl_toplevel_lang, build_dir, test_dir, "parity", [],
+                     test_module="parity_cocotb")
+
+        frames[sim] = np.load(test_dir / PARITY_RESULTS)
+
+    reference = sims[0]
+    if len(sims) < 2:
+        print(f"Only {reference} ran, no frames were compared")
+
+    for sim in sims[1:]:
+        mismatches = np.argwhere(frames[sim] != frames[reference])
+        if len(mismatches):
+            frame, y, x = mismatches[0]
+            raise AssertionError(
+                f"{sim} differs from {reference} in {len(mismatches)} pixels, first in frame {frame} "
+                f"at x={x} y={y}: {frames[sim][frame, y, x]:#04x} != {frames[reference][frame, y, x]:#04x}")
+        print(f"{sim} matches {reference}")
+
+
+if __name__ == "__main__":
+    test_parity()
@@ -0,0 +1,431 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Cycle-accurate reference model of top.sv
+
+The model covers the timing counters, the SPI receiver with its
+synchronizers, the sprite shift register and sprite_access, the
+sprite movement, the animation time and the background latch.
+It is stepped one scanline at a time: the background of a line
+is computed as one vector, the sprite with one step per big pixel.
+
+The model is driven by the pins of the SPI bus. Every pin change
+is passed to spi_event() together with the index of the first
+clock edge that samples the new value, counted from the state
+the model was seeded with. The model must only be stepped over
+a line once all pin changes up to its end are known.
+
+In the reduced frequency mode (misc[4], latched at next_frame)
+counter_h counts by 4: a state draws 4 pixels, a line ends at the
+first counter value >= width - 1, one state after the last active
+one, and the sprite is accessed when counter_h[2] is set.
+"""
+
+import bisect
+import numpy as np
+
+import golden
+from spi_commands import (CMD_SPRITE_DATA, CMD_COLOR1, CMD_COLOR2, CMD_COLOR3, CMD_COLOR4,
+                          CMD_SPRITE_X, CMD_SPRITE_Y, CMD_MISC)
+
+SPRITE_WIDTH  = 12
+SPRITE_HEIGHT = 12
+SPRITE_BITS   = SPRITE_WIDTH * SPRITE_HEIGHT
+
+# Registers written by spi_receiver.sv: command -> (name, mask)
+SPI_REGISTERS = {
+    CMD_COLOR1: ("color1", 0x3F),
+    CMD_COLOR2: ("color2", 0x3F),
+    CMD_COLOR3: ("color3", 0x3F),
+    CMD_COLOR4: ("color4", 0x3F),
+    CMD_MISC:   ("misc",   0x1F),
+}
+
+# Design state that seed() accepts
+STATE = (
+    "color1", "color2", "color3", "color4", "misc",
+    "spi_mode", "spi_cnt", "spi_cmd", "first_data_sprite", "spi_miso",
+    "sprite_x", "sprite_y", "sprite_x_dir", "sprite_y_dir", "divider",
+    "sprite_data", "sprite_line",
+    "cur_time", "time_dir", "bg_sel", "inc_1_or_4",
+)
+
+class TopModel:
+    def __init__(self, width, height, hfront, hsync, hback, vfront, vsync, vback, pixel_size):
+        self.width = width
+        self.height = height
+        self.hblank = hfront + hsync + hback
+        self.vblank = vfront + vsync + vback
+
+        self.pixel_shift = pixel_size.bit_length() - 1
+        self.pixel_mask = pixel_size - 1
+
+        # Width of counter_h_small and counter_v_small
+        htotal = width + self.hblank
+        vtotal = height + self.vblank
+        self.h_small_mask = (1 << ((htotal - 1).bit_length() - self.pixel_shift + 1)) - 1
+        self.v_small_mask = (1 << ((vtotal - 1).bit_length() - self.pixel_shift + 1)) - 1
+
+        # Reset values of top.sv
+        self.color1 = 0x31
+        self.color2 = 0x15
+        self.color3 = 0x0C
+        self.color4 = 0x2C
+        self.misc = 0x06
+
+        self.spi_mode = 0
+        self.spi_cnt = 0
+        self.spi_cmd = 0
+        self.first_data_sprite = 0
+        self.spi_miso = 0
+
+        self.sprite_x = 0
+        self.sprite_y = 0
+        self.sprite_x_dir = 0
+        self.sprite_y_dir = 0
+        self.divider = 0
+
+        self.sprite_data = 0
+        self.sprite_line = 0
+
+        self.cur_time = 0
+        self.time_dir = 0
+        self.bg_sel = 2
+        self.inc_1_or_4 = 0
+
+        # Simulation time of state 0, set by the testbench
+        self.origin = None
+
+        self.seed(-self.hblank, -self.vblank)
+
+    def seed(self, counter_h, counter_v, pins=None, **state):
+        """Start the model at state 0 with the given counters and register values
+
+        pins holds for every SPI pin the values sampled by the clock
+        edges -2 to 1, that is the synchronizer flip-flops of state 0
+        followed by the pin itself. By default the bus is idle.
+        """
+
+        for name, value in state.items():
+            if name not in STATE:
+                raise KeyError(f"Unknown state {name}")
+            setattr(self, name, value)
+
+        self.v = counter_v
+        self.line_start = -((counter_h + self.hblank) // self.step())  # state with counter_h at its minimum
+        self.next_state = 0                             # first state not processed yet
+
+        pins = {"sclk": (0, 0, 0, 0), "mosi": (0, 0, 0, 0), "cs": (1, 1, 1, 1), **(pins or {})}
+
+        # Pin history as (first edge that samples the value, value)
+        self.pins = {name: ([-2, -1, 0, 1], list(pins[name])) for name in ("mosi", "cs")}
+
+        # Pending SPI actions as (state, kind) in order
+        self.actions = []
+        for edge in range(-1, 2):
+            sclk, sclk_before = pins["sclk"][edge + 2], pins["sclk"][edge + 1]
+            if sclk != sclk_before:
+                self.actions.append((edge + 1, "rise" if sclk else "fall"))
+            if pins["cs"][edge + 2] and not pins["cs"][edge + 1]:
+                self.actions.append((edge + 1, "cs"))
+
+        # State in which sprite_access shifted the sprite
+        self.video_shift = None
+
+    def spi_event(self, edge, pin, value):
+        """A pin of the SPI bus changed, edge is the first clock edge that samples it"""
+
+        if edge < self.next_state:
+            raise ValueError(f"SPI event at edge {edge} is behind the model at state {self.next_state}")
+
+        # Two synchronizer flip-flops: the new value is
+        # visible to the receiver in state edge + 1
+        if pin == "sclk":
+            self.actions.append((edge + 1, "rise" if value else "fall"))
+        elif pin in self.pins:
+            edges, values = self.pins[pin]
+            edges.append(edge)
+            values.append(value)
+            if pin == "cs" and value:
+                self.actions.append((edge + 1, "cs"))
+        else:
+            raise KeyError(f"Unknown SPI pin {pin}")
+
+    def pin(self, name, edge):
+        """Value of a pin as sampled by the given clock edge"""
+
+        edges, values = self.pins[name]
+        return values[bisect.bisect_right(edges, edge) - 1]
+
+    def line(self, screen_y):
+        """Step up to the end of the active line screen_y and return its pixels"""
+
+        for _ in range(self.height + self.vblank + 1):
+            v = self.v
+            row = self.step_line()
+            if v == screen_y:
+                return row
+
+        raise ValueError(f"Line {screen_y} is not part of the frame")
+
+    def step_line(self):
+        """Step to the end of the current line, returns the pixels of an active line"""
+
+        row = None
+        if 0 <= self.v < self.height:
+            row = np.zeros(self.width, dtype=np.uint8)
+
+        # State of next_vertical
+        end = self.line_start + self.line_length() - 1
+        state = self.next_state
+
+        while True:
+            # Split the line at every state with SPI activity
+            kinds = []
+            last = end
+            if self.actions and self.actions[0][0] <= end:
+                last = self.actions[0][0]
+                while self.actions and self.actions[0][0] == last:
+                    kinds.append(self.actions.pop(0)[1])
+
+            updates = self.spi_updates(last, kinds) if kinds else None
+            self.video(row, state, last)
+
+            if last == end:
+                self.end_of_line()
+
+            if updates:
+                self.apply(last, *updates)
+
+            state = last + 1
+            if last == end:
+                break
+
+        self.next_state = state
+        self.prune()
+
+        return row
+
+    def step(self):
+        return 4 if self.inc_1_or_4 else 1
+
+    def line_length(self):
+        """States from counter_h at its minimum to next_vertical"""
+
+        if not self.inc_1_or_4:
+            return self.hblank + self.width
+        return -(-(self.hblank + self.width - 1) // 4) + 1
+
+    def counter_h(self, state):
+        return (state - self.line_start) * self.step() - self.hblank
+
+    def video(self, row, first, last):
+        """Pixels and sprite accesses of the states first..last of the current line"""
+
+        if self.inc_1_or_4:
+            self.video_reduced(row, first, last)
+            return
+
+        shift = self.pixel_shift
+        v = self.v
+        h0 = self.counter_h(first)
+        h1 = self.counter_h(last)
+
+        colors = (self.color1, self.color2, self.color3, self.color4)
+
+        # Background, vectorized over the active pixels
+        a0 = max(h0, 0)
+        if row is not None and a0 <= h1:
+            row[a0:h1+1] = golden.background(self.bg_sel, self.cur_time, colors,
+                                             np.arange(a0, h1 + 1), v)
+
+        # Sprite, the counters in the blanking never hit it
+        by = (v >> shift) & self.v_small_mask
+        if not self.sprite_y <= by < self.sprite_y + SPRITE_HEIGHT:
+            return
+
+        new_line = (v & self.pixel_mask) == 0
+        sprite_mode = self.spi_mode and self.spi_cmd == CMD_SPRITE_DATA
+
+        first_block = max(self.sprite_x, a0 >> shift)
+        last_block = min(self.sprite_x + SPRITE_WIDTH, self.width >> shift)
+
+        for bx in range(first_block, last_block):
+            b0 = max(bx << shift, h0)
+            access = (bx << shift) + self.pixel_mask
+            b1 = min(access, h1)
+            if b0 > b1:
+                break
+
+            pixel = (self.sprite_data & 1) if new_line else (self.sprite_line >> (SPRITE_WIDTH - 1)) & 1
+
+            if row is not None:
+                if pixel:
+                    row[b0:b1+1] = self.color1
+                elif self.misc & 0x8:
+                    row[b0:b1+1] = self.color2
+
+            # End of the big pixel, sprite_access.sv
+            if access <= h1:
+                state = access + self.line_start + self.hblank
+                self.sprite_line = ((self.sprite_line << 1) | pixel) & ((1 << SPRITE_WIDTH) - 1)
+
+                if new_line:
+                    bit = self.pin("mosi", state - 1) if sprite_mode else self.sprite_data & 1
+                    self.sprite_data = (self.sprite_data >> 1) | (bit << (SPRITE_BITS - 1))
+                    self.video_shift = state
+
+    def video_reduced(self, row, first, last):
+        """video() in the reduced frequency mode, every state is 4 pixels"""
+
+        shift = self.pixel_shift
+        v = self.v
+
+        colors = (self.color1, self.color2, self.color3, self.color4)
+
+        # Background of the states in the active area
+        hs = self.counter_h(np.arange(first, last + 1))
+        active = hs[(hs >= 0) & (hs < self.width)]
+        if row is not None and len(active):
+            row[active[0]:active[-1]+4] = np.repeat(
+                golden.background(self.bg_sel, self.cur_time, colors, active, v), 4)
+
+        by = (v >> shift) & self.v_small_mask
+        if not self.sprite_y <= by < self.sprite_y + SPRITE_HEIGHT:
+            return
+
+        new_line = (v & self.pixel_mask) == 0
+        sprite_mode = self.spi_mode and self.spi_cmd == CMD_SPRITE_DATA
+
+        # States with the sprite visible, the counters in the blanking never hit it
+        x0 = max(self.sprite_x << shift, 0)
+        x1 = (self.sprite_x + SPRITE_WIDTH) << shift
+        s0 = max(first, self.line_start + -(-(x0 + self.hblank) // 4))
+        s1 = min(last, self.line_start + -(-(x1 + self.hblank) // 4) - 1)
+
+        for state in range(s0, s1 + 1):
+            h = self.counter_h(state)
+
+            pixel = (self.sprite_data & 1) if new_line else (self.sprite_line >> (SPRITE_WIDTH - 1)) & 1
+
+            if row is not None and h < self.width:
+                if pixel:
+                    row[h:h+4] = self.color1
+                elif self.misc & 0x8:
+                    row[h:h+4] = self.color2
+
+            # End of the big pixel, counter_h[2] in this mode
+            if h & 4:
+                self.sprite_line = ((self.sprite_line << 1) | pixel) & ((1 << SPRITE_WIDTH) - 1)
+
+                if new_line:
+                    bit = self.pin("mosi", state - 1) if sprite_mode else self.sprite_data & 1
+                    self.sprite_data = (self.sprite_data >> 1) | (bit << (SPRITE_BITS - 1))
+                    self.video_shift = state
+
+    def spi_updates(self, state, kinds):
+        """Register updates of spi_receiver.sv at the end of a state"""
+
+        updates = {}
+        sprite_bit = None
+
+        mosi = self.pin("mosi", state - 1)
+        cs = self.pin("cs", state - 1)
+        sprite_mode = self.spi_mode and self.spi_cmd == CMD_SPRITE_DATA
+
+        if "fall" in kinds:
+            if not cs:
+                if not self.spi_mode:
+                    updates["spi_cmd"] = ((self.spi_cmd << 1) | mosi) & 0x7
+                    if self.spi_cnt == 7:
+                        updates["spi_mode"] = 1
+                else:
+                    if self.spi_cmd in SPI_REGISTERS:
+                        name, mask = SPI_REGISTERS[self.spi_cmd]
+                        updates[name] = ((getattr(self, name) << 1) | mosi) & mask
+                    elif self.spi_cmd == CMD_SPRITE_DATA:
+                        updates["first_data_sprite"] = 1
+
+                    if self.spi_cnt == 7 and not sprite_mode:
+                        updates["spi_mode"] = 0
+
+                updates["spi_cnt"] = (self.spi_cnt + 1) & 0x7
+
+            # Shifting is not qualified by chip select
+            if sprite_mode:
+                sprite_bit = mosi
+            if self.spi_mode and self.spi_cmd == CMD_SPRITE_X:
+                updates["sprite_x"] = ((self.sprite_x << 1) | mosi) & 0xFF
+            if self.spi_mode and self.spi_cmd == CMD_SPRITE_Y:
+                updates["sprite_y"] = ((self.sprite_y << 1) | mosi) & 0xFF
+
+        # Echo back the previous values
+        if "rise" in kinds and not cs and self.spi_mode:
+            if self.spi_cmd in SPI_REGISTERS:
+                name, mask = SPI_REGISTERS[self.spi_cmd]
+                updates["spi_miso"] = (getattr(self, name) >> (mask.bit_length() - 1)) & 1
+            elif self.spi_cmd == CMD_SPRITE_DATA:
+                updates["spi_miso"] = self.sprite_data & 1
+
+        # End of a sprite transfer
+        if "cs" in kinds and cs and self.first_data_sprite and sprite_mode:
+            updates["spi_mode"] = 0
+            updates["first_data_sprite"] = 0
+
+        return updates, sprite_bit
+
+    def apply(self, state, updates, sprite_bit):
+        for name, value in updates.items():
+            setattr(self, name, value)
+
+        # A shift by sprite_access in the same state already loaded the bit
+        if sprite_bit is not None and self.video_shift != state:
+            self.sprite_data = (self.sprite_data >> 1) | (sprite_bit << (SPRITE_BITS - 1))
+
+    def end_of_line(self):
+        """Updates at next_vertical, the last pixel of a line"""
+
+        v = self.v
+
+        # Background selection is latched after the last line of a big pixel
+        if (v & self.pixel_mask) == self.pixel_mask:
+            self.bg_sel = self.misc & 0x3
+
+        self.line_start += self.line_length()
+
+        if v < self.height - 1:
+            self.v = v + 1
+            return
+
+        # next_frame
+        self.v = -self.vblank
+
+        self.inc_1_or_4 = (self.misc >> 4) & 1
+
+        if not self.time_dir:
+            if self.cur_time == 254:
+                self.time_dir = 1
+            self.cur_time += 1
+        else:
+            if self.cur_time == 1:
+                self.time_dir = 0
+            self.cur_time -= 1
+
+        # Sprite movement, every second frame
+        if (self.misc >> 2) & 1 and self.divider:
+            self.sprite_x, self.sprite_x_dir = golden.move_sprite(
+                self.sprite_x, self.sprite_x_dir, (self.width >> self.pixel_shift) - SPRITE_WIDTH - 1)
+            self.sprite_y, self.sprite_y_dir = golden.move_sprite(
+                self.sprite_y, self.sprite_y_dir, (self.height >> self.pixel_shift) - SPRITE_HEIGHT - 1)
+
+        self.divider ^= 1
+
+    def prune(self):
+        """Forget pin history that no unprocessed state can sample"""
+
+        for edges, values in self.pins.values():
+            index = bisect.bisect_right(edges, self.next_state - 2) - 1
+            if index > 0:
+                del edges[:index]
+                del values[:index]
@@ -0,0 +1,370 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Raster-racing scene planner
+
+top.sv has one sprite and one background selection, but both can
+be rewritten while the frame is drawn. A scene is a list of sprites,
+each a 12x12 bitmap at a position in big pixels, and a list of
+background bands. plan() turns it into a schedule of SPI transactions
+that move the sprite and switch the background between them, each
+transaction at the earliest scanline where it fits, or rejects the
+scene with a SceneError.
+
+The registers shift in one bit at a time and go through intermediate
+values. The planner knows these values and when they are present, and
+only accepts a start if none of them is ever seen: the sprite is not
+hit by the raster while its position changes or its bitmap is loaded,
+and misc is neither latched as background nor drawn as sprite
+background while it changes.
+
+The schedule is a list of (counter_v, data): data is sent in one
+transaction with CS low, starting at the first state of the line,
+the start of the horizontal blanking. Positions in this module count
+clock cycles from the first state of the frame, the first line of
+the vertical front porch right after next_frame.
+"""
+
+import sys
+from pathlib import Path
+
+# Commands, latency and sprite format are shared with the bring-up script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bring-up" / "tt_um_top_mole99"))
+from sprite_bank import SPRITE_WIDTH, SPRITE_HEIGHT, to_bytes
+from spi_commands import LATENCY, CMD_SPRITE_DATA, CMD_COLOR1, CMD_SPRITE_X, CMD_SPRITE_Y, CMD_MISC
+
+class SceneError(Exception):
+    pass
+
+class Raster:
+    """Timing of top.sv"""
+
+    def __init__(self, width, height, hfront, hsync, hback, vfront, vsync, vback, pixel_size):
+        self.width = width
+        self.height = height
+        self.hblank = hfront + hsync + hback
+        self.vblank = vfront + vsync + vback
+        self.htotal = width + self.hblank
+        self.vtotal = height + self.vblank
+
+        self.pixel_size = pixel_size
+        self.pixel_shift = pixel_size.bit_length() - 1
+
+        # Width of counter_v_small, compared as unsigned
+        self.v_small_mask = (1 << ((self.vtotal - 1).bit_length() - self.pixel_shift + 1)) - 1
+
+        self.width_small = width >> self.pixel_shift
+        self.height_small = height >> self.pixel_shift
+
+    @property
+    def frame_cycles(self):
+        return self.htotal * self.vtotal
+
+    def position(self, counter_v, counter_h):
+        return (counter_v + self.vblank) * self.htotal + counter_h + self.hblank
+
+    def line_start(self, counter_v):
+        return self.position(counter_v, -self.hblank)
+
+    def lines(self, first, last):
+        """counter_v and start of the lines with states in first..last-1"""
+
+        for line in range(max(first, 0) // self.htotal, (last - 1) // self.htotal + 1):
+            yield line % self.vtotal - self.vblank, line * self.htotal
+
+    def visible(self, sprite_x, sprite_y, first, last):
+        """Is the sprite at sprite_x, sprite_y hit in any state first..last-1"""
+
+        # The counters in the horizontal blanking never hit it
+        h0 = sprite_x << self.pixel_shift
+        h1 = min((sprite_x + SPRITE_WIDTH) << self.pixel_shift, self.width)
+        if h0 >= h1:
+            return False
+
+        for counter_v, start in self.lines(first, last):
+            v_small = (counter_v >> self.pixel_shift) & self.v_small_mask
+            if not sprite_y <= v_small < sprite_y + SPRITE_HEIGHT:
+                continue
+
+            start += self.hblank
+            if max(first, start + h0) < min(last, start + h1):
+                return True
+
+        return False
+
+    def latch(self, counter_v):
+        """State in which misc is latched as background for the next line"""
+
+        return self.position(counter_v, self.width - 1)
+
+    def latched(self, first, last):
+        """Is the background latched for an active line in any state first..last-1"""
+
+        for counter_v, start in self.lines(first, last):
+            if -1 <= counter_v < self.height - 1 and \
+               (counter_v & (self.pixel_size - 1)) == self.pixel_size - 1 and \
+               first <= self.latch(counter_v) < last:
+                return True
+
+        return False
+
+class Bus:
+    """Timing of the SPI master in clock cycles of the design
+
+    bit_cycles is the SCLK period, byte_gap the extra time between
+    two bytes, cs_tail the time from the last falling SCLK to rising
+    CS and gap the time CS stays high afterwards. jitter is how much
+    later than planned a transaction may start.
+    """
+
+    def __init__(self, bit_cycles, byte_gap=0, cs_tail=0, gap=0, jitter=0):
+        self.bit_cycles = bit_cycles
+        self.byte_gap = byte_gap
+        self.cs_tail = cs_tail
+        self.gap = gap
+        self.jitter = jitter
+
+    def effect(self, nbits):
+        """Cycles from the start until the register written by bit nbits has its new value"""
+
+        return nbits * self.bit_cycles + (nbits - 1) // 8 * self.byte_gap + LATENCY
+
+    def cs_high(self, nbytes):
+        return 8 * nbytes * self.bit_cycles + (nbytes - 1) * self.byte_gap + self.cs_tail
+
+    def length(self, nbytes):
+        return self.cs_high(nbytes) + self.gap
+
+# PIOSPI of the bring-up board at 20 MHz with the design at 40 MHz,
+# the bytes of a transaction are fed back to back by DMA, CS is
+# handled by MicroPython and the start follows next_frame by busy
+# waiting: rough estimates, not measured
+BOARD_BUS = Bus(bit_cycles=2, byte_gap=0, cs_tail=800, gap=800, jitter=4000)
+
+def shift_values(old, new, mask):
+    """Values of a register while the byte new is shifted in,
+    after 0 to 8 bits"""
+
+    return [((old << i) | (new >> (8 - i))) & mask for i in range(9)]
+
+# A write of a transaction: (cmd, payload, old value, release, deadline)
+# release is a state after which its first bit must take effect,
+# deadline the state in which its new value must be there
+def conflict(raster, bus, start, writes, sprite_x, sprite_y):
+    """Why the transaction cannot start at start, as (reason, late)
+    with late if starting later cannot help, or None"""
+
+    nbytes = sum(1 + len(payload) for _, payload, _, _, _ in writes)
+    end = start + bus.jitter + bus.length(nbytes)
+    if end > raster.frame_cycles:
+        return "does not fit into the frame", True
+
+    x, y = sprite_x, sprite_y
+    nbits = 0
+
+    for cmd, payload, old, release, deadline in writes:
+        nbits += 8
+        first = start + bus.effect(nbits + 1)
+
+        if cmd == CMD_SPRITE_DATA:
+            nbits += 8 * len(payload)
+
+            # Loading ends when CS is seen high, a video shift
+            # before that would insert a wrong bit
+            done = start + bus.jitter + bus.cs_high(nbytes) + LATENCY
+            if done > deadline:
+                return "sprite data too late", True
+            if raster.visible(x, y, first, done):
+                return "sprite hit while loading", False
+            continue
+
+        # States of the values after 0 to 7 bits
+        edges = [start] + [start + bus.effect(nbits + i) for i in range(1, 9)]
+        nbits += 8
+
+        done = edges[8] + bus.jitter
+        if done > deadline:
+            return f"command {cmd} too late", True
+        if release is not None and first <= release:
+            return f"command {cmd} too early", False
+
+        if cmd == CMD_SPRITE_Y:
+            values = shift_values(old, payload[0], 0xFF)
+            if any(raster.visible(x, values[i], edges[i], edges[i+1] + bus.jitter) for i in range(8)):
+                return "sprite hit while moving vertically", False
+            y = values[8]
+        elif cmd == CMD_SPRITE_X:
+            values = shift_values(old, payload[0], 0xFF)
+            if any(raster.visible(values[i], y, edges[i], edges[i+1] + bus.jitter) for i in range(8)):
+                return "sprite hit while moving horizontally", False
+            x = values[8]
+        elif cmd == CMD_MISC:
+            if raster.latched(first, done):
+                return "background latched while changing", False
+            if raster.visible(x, y, first, done):
+                return "sprite background drawn while changing", False
+
+    return None
+
+def place(raster, bus, options, first_line, bus_free, sprite_x, sprite_y, name):
+    """Earliest line from first_line on at which one of the
+    alternative transactions fits, returns it and the line"""
+
+    options = list(options)
+
+    for line in range(first_line, raster.height):
+        start = raster.line_start(line)
+        if start < bus_free:
+            continue
+
+        for writes in list(options):
+            reason = conflict(raster, bus, start, writes, sprite_x, sprite_y)
+            if reason is None:
+                return writes, line
+            if reason[1]:
+                options.remove(writes)
+
+        if not options:
+            raise SceneError(f"{name}: {reason[0]} (earliest start in line {line})")
+
+    raise SceneError(f"{name}: does not fit into the frame")
+
+def plan(sprites, bands, raster, bus, colors=None, sprite_bg=False):
+    """Schedule for a scene, repeated every frame
+
+    sprites is a list of (bitmap, sprite_x, sprite_y) and bands a list
+    of (first big line, bg_sel), both sorted from the top. The first
+    band starts at 0. colors (color1, color2, color3, color4) are
+    written in the vertical blanking, None keeps them.
+    """
+
+    if not sprites:
+        raise SceneError("A scene needs at least one sprite")
+    if not bands or bands[0][0] != 0:
+        raise SceneError("The first band must start at line 0")
+
+    for (bitmap, x, y), (_, _, next_y) in zip(sprites, sprites[1:] + [(None, 0, raster.height_small)]):
+        if x + SPRITE_WIDTH > raster.width_small or y + SPRITE_HEIGHT > next_y:
+            raise SceneError(f"Sprite at {x}, {y} is not fully visible or overlaps the next one")
+
+    for (first, bg), (next_first, _) in zip(bands, bands[1:] + [(raster.height_small, 0)]):
+        if not first < next_first or bg not in range(4):
+            raise SceneError(f"Band at {first} is empty or has no valid background")
+
+    size = raster.pixel_size
+    misc = [int(sprite_bg) << 3 | bg for _, bg in bands]
+
+    # The frame starts with the first sprite, its background and the colors,
+    # the previous frame left the registers of the last sprite and band
+    last_bitmap, last_x, last_y = sprites[-1]
+    first_bitmap, first_x, first_y = sprites[0]
+    first_pixel = raster.position(first_y * size, first_x * size)
+
+    # The sprite moves with either coordinate first, the
+    # other order can avoid a hit by an intermediate position
+    def move(x, y, last_x, last_y, deadline):
+        move_x = (CMD_SPRITE_X, bytes([x]), last_x, None, deadline)
+        move_y = (CMD_SPRITE_Y, bytes([y]), last_y, None, deadline)
+        return ([move_y, move_x], [move_x, move_y])
+
+    colors = [] if colors is None else \
+             [(CMD_COLOR1 + i, bytes([color]), None, None, raster.position(0, 0))
+              for i, color in enumerate(colors)]
+
+    setup = [colors + order + [
+        (CMD_MISC, bytes([misc[0]]), misc[-1], None, raster.latch(-1)),
+        (CMD_SPRITE_DATA, to_bytes(first_bitmap), None, None, first_pixel),
+    ] for order in move(first_x, first_y, last_x, last_y, first_pixel)]
+
+    # Then every other sprite and band, earliest deadline first
+    events = []
+    for (bitmap, x, y), (last_bitmap, last_x, last_y) in zip(sprites[1:], sprites):
+        deadline = raster.position(y * size, x * size)
+        load = []
+        if bitmap != last_bitmap:
+            load.append((CMD_SPRITE_DATA, to_bytes(bitmap), None, None, deadline))
+        options = [order + load for order in move(x, y, last_x, last_y, deadline)]
+        events.append((deadline, options, (last_y + SPRITE_HEIGHT) * size, f"Sprite at {x}, {y}"))
+
+    for index, (first, bg) in enumerate(bands[1:], 1):
+        deadline = raster.latch(first * size - 1)
+        release = raster.latch((first - 1) * size - 1)
+        options = [[(CMD_MISC, bytes([misc[index]]), misc[index - 1], release, deadline)]]
+        events.append((deadline, options, -raster.vblank, f"Band at {first}"))
+
+    events.sort(key=lambda event: event[0])
+
+    schedule = []
+    bus_free = 0
+    sprite_x, sprite_y = last_x, last_y
+
+    for options, first_line, name in [(setup, -raster.vblank, "Frame start")] + \
+                                     [event[1:] for event in events]:
+        writes, line = place(raster, bus, options, first_line, bus_free, sprite_x, sprite_y, name)
+
+        data = b"".join(bytes([cmd]) + payload for cmd, payload, _, _, _ in writes)
+        schedule.append((line, data))
+        bus_free = raster.line_start(line) + bus.jitter + bus.length(len(data))
+
+        for cmd, payload, _, _, _ in writes:
+            if cmd == CMD_SPRITE_X:
+                sprite_x = payload[0]
+            if cmd == CMD_SPRITE_Y:
+                sprite_y = payload[0]
+
+    return schedule
+
+def pack(bitmaps, xs, bands, raster, bus, **kwargs):
+    """Stack sprites from the top as tightly as plan() allows
+
+    Returns the sprites that fit as (bitmap, sprite_x, sprite_y).
+    """
+
+    sprites = []
+    y = 0
+
+    for bitmap, x in zip(bitmaps, xs):
+        while y + SPRITE_HEIGHT <= raster.height_small:
+            try:
+                plan(sprites + [(bitmap, x, y)], bands, raster, bus, **kwargs)
+                break
+            except SceneError:
+                y += 1
+        else:
+            break
+
+        sprites.append((bitmap, x, y))
+        y += SPRITE_HEIGHT
+
+    return sprites
+
+def save_schedule(schedule, raster, filename):
+    """Write the schedule as a Python module for the bring-up board,
+    every transaction with its start in clock cycles after next_frame"""
+
+    with open(filename, "w") as f:
+        f.write("# Generated by tb/scene.py: (clock cycles after next_frame, data)\n")
+        f.write("SCHEDULE = [\n")
+        for line, data in schedule:
+            f.write(f"    ({raster.line_start(line)}, {bytes(data)!r}),\n")
+        f.write("]\n")
+
+# Plan the scene of scene_test for the bring-up board
+if __name__ == "__main__":
+    from tb_cocotb import SPRITE_TT, SPRITE_SPIRAL, SPRITE_HEART, SPRITE_DRINK
+
+    raster = Raster(800, 600, 40, 128, 88, 1, 4, 23, 8)
+
+    colors = (0x30, 0x03, 0x0C, 0x3C)
+    bands = [(0, 2), (15, 3), (30, 1), (45, 3), (60, 2)]
+
+    bitmaps = [SPRITE_TT, SPRITE_SPIRAL, SPRITE_HEART, SPRITE_DRINK] * 4
+    xs = [3, 23, 44, 64, 85, 70, 50, 30] * 2
+
+    sprites = pack(bitmaps, xs, bands, raster, BOARD_BUS, colors=colors, sprite_bg=True)
+    schedule = plan(sprites, bands, raster, BOARD_BUS, colors=colors, sprite_bg=True)
+
+    filename = sys.argv[1] if len(sys.argv) > 1 else "scene_schedule.py"
+    save_schedule(schedule, raster, filename)
+    print(f"{len(sprites)} sprites in {len(schedule)} transactions written to {filename}")
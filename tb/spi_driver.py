@@ -0,0 +1,130 @@
+# SPDX-FileCopyrightText: © 2022 Leo Moser <leo.moser@pm.me>
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Bus functional model of an SPI master for spi_receiver.sv
+
+SPI mode 1 (CPOL=0, CPHA=1), 8 bits MSB first, CS active low.
+
+The pins only change at falling edges of clk, so every change is
+sampled by the next rising edge and the timing of a transaction is
+known to the cycle. A transaction started in a state (see transfer())
+changes a register in the state effect_cycles(n) later, where n is
+the number of bits sent up to and including the last bit of the value.
+"""
+
+import sys
+from pathlib import Path
+
+from cocotb.triggers import FallingEdge, Timer
+
+# The commands and the latency are shared with the bring-up script
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bring-up" / "tt_um_top_mole99"))
+from spi_commands import LATENCY, CMD_SPRITE_DATA
+
+class SpiDriver:
+    def __init__(self, dut, clk_period_ns, half_period=2, gap=4):
+        """half_period is the time SCLK is high and low in clock cycles,
+        gap the time CS stays high after a transaction"""
+
+        # The synchronizers need to sample every level of SCLK
+        # at least twice for a reliable edge detection
+        if half_period < 2:
+            raise ValueError("SCLK must be high and low for at least two clock cycles")
+
+        self.clk = dut.clk
+        self.sclk = dut.spi_sclk
+        self.mosi = dut.spi_mosi
+        self.miso = dut.spi_miso
+        self.cs = dut.spi_cs
+
+        self.clk_period_ns = clk_period_ns
+        self.half_period = half_period
+        self.gap = gap
+
+        # Idle bus
+        self.sclk.value = 0
+        self.mosi.value = 0
+        self.cs.value = 1
+
+    def cycles(self, nbytes):
+        """Clock cycles of a transaction of nbytes including the gap after it"""
+
+        return (16 * nbytes + 1) * self.half_period + self.gap
+
+    def effect_cycles(self, nbits):
+        """Clock cycles from the start of a transaction until
+        the register written by bit nbits has its new value"""
+
+        return 2 * nbits * self.half_period + LATENCY
+
+    async def wait_cycles(self, cycles):
+        await Timer(cycles * self.clk_period_ns, units="ns")
+
+    async def transfer(self, data, nbits=None):
+        """One transaction with CS low for all bytes, returns the bytes
+        read from MISO. It starts at the next falling edge of clk, that
+        is in the state the design is in right now.
+
+        nbits ends the transaction early after that many bits, the
+        last byte read is then padded with zeros."""
+
+        bits = [(byte >> bit) & 1 for byte in data for bit in range(7, -1, -1)]
+        if nbits is not None:
+            bits = bits[:nbits]
+
+        await FallingEdge(self.clk)
+
+        self.cs.value = 0
+
+        read = []
+        for index, bit in enumerate(bits):
+            await self.wait_cycles(self.half_period)
+
+            # Sample MISO as late as possible, right before the
+            # next rising SCLK; the design echoes a bit LATENCY
+            # cycles after rising SCLK
+            if index:
+                read.append(self.miso.value.integer)
+
+            self.sclk.value = 1
+            self.mosi.value = bit
+
+            await self.wait_cycles(self.half_period)
+            self.sclk.value = 0
+
+        await self.wait_cycles(self.half_period)
+        if bits:
+            read.append(self.miso.value.integer)
+
+        self.cs.value = 1
+        self.mosi.value = 0
+
+        await self.wait_cycles(self.gap)
+
+        packed = bytearray()
+        for index in range(0, len(read), 8):
+            value = 0
+            for bit in read[index:index+8]:
+                value = value << 1 | bit
+            packed.append(value << (8 - len(read[index:index+8])))
+
+        return bytes(packed)
+
+    async def write(self, cmd, data):
+        """Command and payload in one transaction, returns the bytes read
+        while sending the payload, i.e. the previous register contents"""
+
+        return (await self.transfer([cmd, *data]))[1:]
+
+    async def write_many(self, commands):
+        """Several commands as (cmd, data) in one transaction,
+        the sprite data must be last since it ends with CS"""
+
+        data = []
+        for index, (cmd, payload) in enumerate(commands):
+            if cmd == CMD_SPRITE_DATA and index != len(commands) - 1:
+                raise ValueError("Sprite data must be the last command of a transaction")
+            data += [cmd, *payload]
+
+        await self.transfer(data)
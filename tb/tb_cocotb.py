@@ -2,46 +2,95 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-import random
+import io
+import sys
+import zlib
+import hashlib
+import functools
+import shutil
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image, ImageChops
+import numpy as np
+from PIL import Image
 
 import cocotb
 from cocotb.clock import Clock
 from cocotb.runner import get_runner
-from cocotb.triggers import Timer, RisingEdge, FallingEdge
+from cocotb.triggers import Timer, RisingEdge, FallingEdge, Edge, ReadOnly
+from cocotb.utils import get_sim_time
 from cocotb.types import LogicArray
 
 from cocotbext.spi import SpiBus, SpiConfig, SpiMaster
 
-# Parameters
-WIDTH    = 800;
-HEIGHT   = 600;
+BRING_UP = Path(__file__).resolve().parent.parent / "bring-up" / "tt_um_top_mole99"
+sys.path.insert(0, str(BRING_UP))
+import sprite_bank
+from spi_commands import (CMD_SPRITE_DATA, CMD_COLOR1, CMD_COLOR2, CMD_COLOR3, CMD_COLOR4,
+                          CMD_SPRITE_X, CMD_SPRITE_Y, CMD_MISC)
 
-HFRONT   = 40;
-HSYNC    = 128;
-HBACK    = 88;
+import golden
+import reference
+import scene
+from spi_driver import SpiDriver
+
+# Parameters, same as in top.sv
+# Set PIXEL_SIZE to 1, 2 or 4 for a scaled-down raster,
+# 8 is the real SVGA timing
+PIXEL_SIZE = int(os.getenv("PIXEL_SIZE", 8))
+SCALE = 8 // PIXEL_SIZE
+
+WIDTH    = 100 * PIXEL_SIZE;
+HEIGHT   = 75 * PIXEL_SIZE;
+
+HFRONT   = 40 // SCALE;
+HSYNC    = 128 // SCALE;
+HBACK    = 88 // SCALE;
 
 VFRONT   = 1;
-VSYNC    = 4;
-VBACK    = 23;
-
-CMD_SPRITE_DATA = 0x0
-CMD_COLOR1      = 0x1
-CMD_COLOR2      = 0x2
-CMD_COLOR3      = 0x3
-CMD_COLOR4      = 0x4
-CMD_SPRITE_X    = 0x5
-CMD_SPRITE_Y    = 0x6
-CMD_MISC        = 0x7
+VSYNC    = max(4 // SCALE, 1);
+VBACK    = 23 // SCALE;
+
+SVGA = PIXEL_SIZE == 8
+
+# In the reduced frequency mode (misc[4]) counter_h counts by 4,
+# states from hsync to the first pixel
+HBACK_REDUCED = (HFRONT + HSYNC + HBACK) // 4 - -(-(HFRONT + HSYNC) // 4)
+
+# One sample per big pixel, see draw_blocks()
+BLOCK_WIDTH  = WIDTH // PIXEL_SIZE
+BLOCK_HEIGHT = HEIGHT // PIXEL_SIZE
+
+CLK_PERIOD_NS = 10
+
+# Set FRAME_DUMP=1 to let the simulator write the frames
+FRAME_DUMP_PLUSARG = "FRAME_DUMP"
+FRAME_DUMP_FILE = "frames.bin"
+
+# Reference frames are stored in GOLDEN_CACHE_DIR, set by the
+# runner and shared by all tests, up to GOLDEN_CACHE_SIZE bytes
+GOLDEN_CACHE_DIR = os.getenv("GOLDEN_CACHE_DIR")
+GOLDEN_CACHE_SIZE = int(os.getenv("GOLDEN_CACHE_SIZE", 64 << 20))
+
+# Images written by the tests: "always", "failure" for only
+# the mismatch images of a failing capture or "never"
+ARTIFACTS = os.getenv("ARTIFACTS", "always")
+
+# Images are encoded on background threads, the
+# simulation waits if too many are pending
+ARTIFACT_WORKERS = 2
+ARTIFACT_QUEUE = 8
+
+# Frames per background in movement_test, enough for the
+# sprite to bounce at both edges with the scaled-down raster
+MOVEMENT_FRAMES = int(os.getenv("MOVEMENT_FRAMES", 2 if SVGA else 64))
 
 # Global variables
 COLOR1 = 0x31
 COLOR2 = 0x15
 COLOR3 = 0x0C
-COLOR4 = 0x21
-
-PIXEL_SIZE = 8
+COLOR4 = 0x2C
 
 SPRITE_X = 0
 SPRITE_Y = 0
@@ -49,68 +98,20 @@ SPRITE_Y = 0
 SPRITE_HEIGHT = 12
 SPRITE_WIDTH = 12
 
-SPRITE_TT = [
-    [0,0,0,1,1,1,1,1,1,0,0,0],
-    [0,0,1,0,0,0,0,0,0,1,0,0],
-    [0,1,1,1,1,1,1,0,0,0,1,0],
-    [1,1,1,1,1,1,1,0,0,0,0,1],
-    [0,0,0,1,1,0,0,0,0,0,0,1],
-    [1,0,0,1,1,1,1,1,1,1,0,1],
-    [1,0,0,1,1,1,1,1,1,1,0,1],
-    [1,0,0,1,1,0,1,1,0,0,0,1],
-    [1,0,0,1,1,0,1,1,0,0,0,1],
-    [0,1,0,0,0,0,1,1,0,0,1,0],
-    [0,0,1,0,0,0,1,1,0,1,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-]
-
-SPRITE_DRINK = [
-    [0,0,0,0,0,0,0,1,1,0,0,0],
-    [0,0,0,0,0,0,1,0,0,0,0,0],
-    [1,1,1,1,0,1,0,1,1,1,1,0],
-    [1,0,0,0,0,1,0,0,0,0,1,0],
-    [0,1,1,1,1,1,1,1,1,1,0,0],
-    [0,0,1,1,0,0,1,1,1,0,0,0],
-    [0,0,0,1,0,0,1,1,0,0,0,0],
-    [0,0,0,0,1,1,1,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-]
-
-SPRITE_HEART = [
-    [0,0,1,1,0,0,0,1,1,0,0,0],
-    [0,1,1,1,1,0,1,1,1,1,0,0],
-    [1,1,1,1,1,1,1,1,0,1,1,0],
-    [1,1,1,1,1,1,1,1,1,0,1,0],
-    [1,1,1,1,1,1,1,1,1,0,1,0],
-    [1,1,1,1,1,1,1,1,0,1,1,0],
-    [0,1,1,1,1,1,1,1,1,1,0,0],
-    [0,0,1,1,1,1,0,1,1,0,0,0],
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-    [0,0,0,0,1,1,1,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-    [0,0,0,0,0,1,0,0,0,0,0,0],
-]
-
-SPRITE_SPIRAL = [
-    [0,0,0,1,1,1,1,1,0,0,0,0],
-    [0,1,1,0,0,0,0,0,1,1,0,0],
-    [1,0,0,0,0,0,0,0,0,0,1,0],
-    [1,0,0,0,0,0,0,0,0,0,1,0],
-    [0,0,0,0,1,1,1,1,0,0,0,1],
-    [0,0,0,1,0,0,0,0,1,0,0,1],
-    [0,0,1,0,0,1,1,0,1,0,0,1],
-    [0,0,1,0,1,0,0,0,1,0,0,1],
-    [0,0,1,0,1,0,0,1,0,0,1,0],
-    [0,0,1,0,0,1,1,0,0,0,1,0],
-    [0,0,0,1,0,0,0,0,1,1,0,0],
-    [0,0,0,0,1,1,1,1,0,0,0,0],
-]
+# Sprites from the sprite bank written by sprite2bit.py,
+# the same file as on the bring-up board
+SPRITE_BANK = sprite_bank.SpriteBank((BRING_UP / "sprites.bank").read_bytes())
+
+SPRITE_TT     = sprite_bank.unpack(SPRITE_BANK["tt"])
+SPRITE_DRINK  = sprite_bank.unpack(SPRITE_BANK["drink"])
+SPRITE_HEART  = sprite_bank.unpack(SPRITE_BANK["heart"])
+SPRITE_SPIRAL = sprite_bank.unpack(SPRITE_BANK["spiral"])
 
 SPRITE = SPRITE_TT
 
+# Colors after reset
+COLORS_DEFAULT = (COLOR1, COLOR2, COLOR3, COLOR4)
+
 ENABLE_SPRITE_BG = 0
 BACKGROUND_SEL = 2
 
@@ -121,109 +122,528 @@ async def reset_dut(rst_ni, duration_ns):
     rst_ni.value = 1
     rst_ni._log.debug("Reset complete")
 
-# Draw the current frame and return it
-async def draw_frame(dut):
-    screen_x = -HBACK
-    screen_y = -VBACK
-
-    print(dut.timing_hor.counter.value.integer)
-    print(dut.timing_ver.counter.value.integer)
-    print(f"line {screen_y}")
-
-    image = Image.new('RGB', (WIDTH, HEIGHT), "black")
-    pixels = image.load()
-
-    while (1):
-        await RisingEdge(dut.clk)
-    
-        # Expand color data
-        r = dut.rrggbb.value[0:1] << 6
-        if (r & 1<<6):
-            r = r | 0x3F
-        g = dut.rrggbb.value[2:3] << 6
-        if (g & 1<<6):
-            g = g | 0x3F
-        b = dut.rrggbb.value[4:5] << 6
-        if (b & 1<<6):
-            b = b | 0x3F
-
-        # Inside drawing area
-        if screen_y >= 0 and screen_y < HEIGHT and screen_x >= 0 and screen_x < WIDTH:
-            #print(dut.timing_hor.counter.value.integer)
-            #print(dut.timing_ver.counter.value.integer)
-            pixels[screen_x, screen_y] = (r, g, b)
-        
-        # Received hsync
-        if (dut.hsync.value == 1):
-            await FallingEdge(dut.hsync)
-            screen_y += 1
-            print(dut.timing_hor.counter.value.integer)
-            print(dut.timing_ver.counter.value.integer)
-            print(f"line {screen_y}")
-            screen_x = -HBACK
-
-        # Received vsync
-        elif (dut.vsync.value == 1):
-            await FallingEdge(dut.vsync)
-            await FallingEdge(dut.hsync)
-            return image
+# Map frame n of the frame dump written by
+# frame_capture.sv, the file is not copied
+def read_frame_dump(filename, index):
+    return np.memmap(filename, dtype=np.uint8, mode='r',
+                     offset=index * WIDTH * HEIGHT, shape=(HEIGHT, WIDTH))
+
+# Compare a captured line with its reference
+def check_line(screen_y, row, expected):
+    mismatches = np.flatnonzero(row != expected)
+    if len(mismatches):
+        screen_x = mismatches[0]
+        raise AssertionError(f"Line {screen_y} differs at column {screen_x}: "
+                             f"expected {expected[screen_x]:#04x}, got {row[screen_x]:#04x}")
+
+# Line check of draw_frame() and draw_blocks(): every row is
+# compared with gold and the model, step is the size of a
+# captured pixel. On a difference the rows returned by
+# captured() are saved together with their references
+def line_checker(gold, model, captured, shape, step=1):
+    expected = np.zeros(shape, dtype=np.uint8)
+
+    def check(y, row):
+        references = []
+        if gold is not None:
+            references.append(gold[y])
+        if model is not None:
+            references.append(model.line(y * step)[::step])
+
+        for reference in references:
+            expected[y] = reference
+            if not np.array_equal(row, reference):
+                save_mismatch(captured(), expected, y)
+            check_line(y, row, reference)
+
+    return check
+
+# Value of a signal, fails if a bit is X or Z, the
+# reference model only knows resolved values
+def resolve_int(handle):
+    value = handle.value
+    if not value.is_resolvable:
+        raise AssertionError(f"{handle._path} is {value.binstr}, not resolved")
+    return value.integer
+
+# Reference model of the design with the geometry of the testbench
+def new_model():
+    return reference.TopModel(WIDTH, HEIGHT, HFRONT, HSYNC, HBACK,
+                              VFRONT, VSYNC, VBACK, PIXEL_SIZE)
+
+# Signals of the design for every state of the reference model
+def state_handles(dut):
+    spi = dut.spi_receiver_inst
+    movement = dut.sprite_movement_inst
+
+    return {
+        "color1": spi.color1, "color2": spi.color2, "color3": spi.color3,
+        "color4": spi.color4, "misc": spi.misc,
+        "spi_mode": spi.spi_mode, "spi_cnt": spi.spi_cnt, "spi_cmd": spi.spi_cmd,
+        "first_data_sprite": spi.first_data_sprite, "spi_miso": spi.spi_miso,
+        "sprite_x": movement.sprite_x, "sprite_y": movement.sprite_y,
+        "sprite_x_dir": movement.sprite_x_dir, "sprite_y_dir": movement.sprite_y_dir,
+        "divider": movement.divider,
+        "sprite_data": dut.sprite_data_inst.sprite_data,
+        "sprite_line": dut.sprite_access_inst.sprite_line,
+        "cur_time": dut.cur_time, "time_dir": dut.time_dir,
+        "bg_sel": dut.bg_sel, "inc_1_or_4": dut.inc_1_or_4,
+    }
+
+# Seed the reference model with the current state of the
+# design and pass it every change on the SPI pins from now on
+async def start_model(dut, model):
+    await ReadOnly()
+
+    spi = dut.spi_receiver_inst
+
+    # Values sampled by the clock edges -2 to 1, see TopModel.seed()
+    pins = {}
+    for name, pin, sync in (("sclk", dut.spi_sclk, spi.synchronizer_spi_sclk),
+                            ("mosi", dut.spi_mosi, spi.synchronizer_spi_mosi),
+                            ("cs",   dut.spi_cs,   spi.synchronizer_spi_cs)):
+        pipe = resolve_int(sync.pipe)
+        pins[name] = [pipe >> 1, pipe >> 1, pipe & 1, resolve_int(pin)]
+    pins["sclk"][0] = resolve_int(spi.spi_sclk_delayed)
+
+    state = {name: resolve_int(handle) for name, handle in state_handles(dut).items()}
+
+    model.seed(dut.timing_hor.counter.value.signed_integer,
+               dut.timing_ver.counter.value.signed_integer, pins, **state)
+    model.origin = round(get_sim_time("ps"))
+
+    period = CLK_PERIOD_NS * 1000
+
+    async def monitor(name, pin):
+        while True:
+            await Edge(pin)
+            edge = (round(get_sim_time("ps")) - model.origin) // period + 1
+            model.spi_event(edge, name, resolve_int(pin))
+
+    for name, pin in (("sclk", dut.spi_sclk), ("mosi", dut.spi_mosi), ("cs", dut.spi_cs)):
+        cocotb.start_soon(monitor(name, pin))
+
+# Capture the active area of the current frame
+# as 6-bit color codes, must be started right
+# after the falling edge of hsync in the first
+# line of the vertical back porch
+# If gold is given, every line is compared as soon
+# as the design moved on to the next line and the
+# first difference fails
+# gold may be a function, it is called right
+# before the first line of the active area
+# With a reference model, every line is also compared
+# to the model running in lockstep with the design,
+# this covers registers written during the frame
+# In the reduced frequency mode every sample is 4 pixels
+async def draw_frame(dut, frame=None, gold=None, model=None):
+    rrggbb = dut.rrggbb
+    clk_edge = RisingEdge(dut.clk)
+    hsync_edge = FallingEdge(dut.hsync)
+
+    if model is not None and model.origin is None:
+        await start_model(dut, model)
+
+    # Skip the remaining lines of the vertical back porch
+    for _ in range(VBACK - 1):
+        await hsync_edge
+
+    if callable(gold):
+        gold = gold()
+
+    reduced = dut.inc_1_or_4.value == 1
+
+    # The simulator samples the pixels itself
+    if FRAME_DUMP_PLUSARG in cocotb.plusargs:
+        filename = cocotb.plusargs[FRAME_DUMP_PLUSARG]
+        index = dut.frame_capture_inst.frame_index.value.integer
+
+        check = line_checker(gold, model, lambda: read_frame_dump(filename, index), (HEIGHT, WIDTH))
+
+        if gold is not None or model is not None:
+            with open(filename, 'rb') as f:
+                await hsync_edge
+
+                # A line is in the file once the next one started
+                for screen_y in range(HEIGHT):
+                    await hsync_edge
+                    row = np.frombuffer(os.pread(f.fileno(), WIDTH, (index * HEIGHT + screen_y) * WIDTH),
+                                        dtype=np.uint8)
+                    check(screen_y, row)
+
+        # Align to the next frame
+        await FallingEdge(dut.vsync)
+        await hsync_edge
+
+        dump = read_frame_dump(filename, index)
+        if frame is None:
+            return dump
+        frame[:] = dump
+        return frame
+
+    if frame is None:
+        frame = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+
+    check = line_checker(gold, model, lambda: frame, (HEIGHT, WIDTH))
+
+    row = bytearray(WIDTH)
+
+    for screen_y in range(HEIGHT):
+        await hsync_edge
+
+        if screen_y:
+            check(screen_y - 1, frame[screen_y - 1])
+
+        # Sleep through the horizontal back porch
+        # and wake up half a cycle before the first pixel
+        if not reduced:
+            await Timer((HBACK + 0.5) * CLK_PERIOD_NS, units="ns")
+
+            for screen_x in range(WIDTH):
+                await clk_edge
+                row[screen_x] = rrggbb.value.integer
         else:
-            screen_x += 1
+            await Timer((HBACK_REDUCED + 0.5) * CLK_PERIOD_NS, units="ns")
 
-def sprite2bytes(sprite):
-    bits = ""
-    
-    for row in sprite:
-        for bit in row:
-            bits += str(bit)
-    
-    byte_data = [int(bits[x:x+8], 2) for x in range(0, len(bits), 8)]
-    
-    return byte_data
+            for screen_x in range(0, WIDTH, 4):
+                await clk_edge
+                row[screen_x:screen_x+4] = bytes((rrggbb.value.integer,)) * 4
+
+        frame[screen_y] = np.frombuffer(row, dtype=np.uint8)
+
+    # Align to the next frame
+    await FallingEdge(dut.vsync)
+    check(HEIGHT - 1, frame[HEIGHT - 1])
+    await hsync_edge
+
+    return frame
+
+# Capture consecutive frames, must be started like draw_frame()
+# All frames share one buffer that is only valid until the
+# next frame is requested, long runs need constant memory
+# gold is called with the index of the frame in the stream
+# and returns its reference frame
+async def stream_frames(dut, count, gold=None, model=None):
+    frame = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+
+    for index in range(count):
+        await draw_frame(dut, frame, gold=None if gold is None else lambda: gold(index), model=model)
+        yield frame
+
+# Fail if a pixel of the last frame differs from the first pixel
+# of its big pixel, counted by frame_capture.sv
+def check_uniform(dut):
+    capture = dut.frame_capture_inst
+    nonuniform = capture.nonuniform.value.signed_integer
+    if nonuniform:
+        raise AssertionError(f"{nonuniform} pixels differ from their big pixel, the first at "
+                             f"x={capture.first_x.value.signed_integer} "
+                             f"y={capture.first_y.value.signed_integer}")
+
+# Capture the current frame with one sample per big pixel,
+# BLOCK_HEIGHT x BLOCK_WIDTH color codes, must be started
+# like draw_frame()
+# Only the first pixel of every big pixel is sampled, that
+# all others have the same color is checked by the simulator
+# and fails at the end of the frame: backgrounds 1, 2 and,
+# depending on the time, 3 are not made of big pixels, use
+# draw_frame() for them
+# gold and model work as in draw_frame(), gold has block size,
+# see golden.to_blocks()
+async def draw_blocks(dut, blocks=None, gold=None, model=None):
+    rrggbb = dut.rrggbb
+    clk_edge = RisingEdge(dut.clk)
+    hsync_edge = FallingEdge(dut.hsync)
+
+    if model is not None and model.origin is None:
+        await start_model(dut, model)
+
+    # Skip the remaining lines of the vertical back porch
+    for _ in range(VBACK - 1):
+        await hsync_edge
+
+    if callable(gold):
+        gold = gold()
+
+    if blocks is None:
+        blocks = np.zeros((BLOCK_HEIGHT, BLOCK_WIDTH), dtype=np.uint8)
+
+    check = line_checker(gold, model, lambda: blocks, (BLOCK_HEIGHT, BLOCK_WIDTH), PIXEL_SIZE)
+
+    # The simulator samples the pixels itself
+    if FRAME_DUMP_PLUSARG in cocotb.plusargs:
+        index = dut.frame_capture_inst.frame_index.value.integer
+
+        await FallingEdge(dut.vsync)
+        blocks[:] = golden.to_blocks(read_frame_dump(cocotb.plusargs[FRAME_DUMP_PLUSARG], index),
+                                     PIXEL_SIZE)
+        for block_y in range(BLOCK_HEIGHT):
+            check(block_y, blocks[block_y])
+        check_uniform(dut)
+
+        await hsync_edge
+        return blocks
+
+    row = bytearray(BLOCK_WIDTH)
+
+    for screen_y in range(HEIGHT):
+        await hsync_edge
+
+        # First line of a row of big pixels
+        if screen_y % PIXEL_SIZE:
+            continue
+
+        block_y = screen_y // PIXEL_SIZE
+        if block_y:
+            check(block_y - 1, blocks[block_y - 1])
+
+        # Wake up half a cycle before the first pixel
+        # of the line and then of every big pixel
+        await Timer((HBACK + 0.5) * CLK_PERIOD_NS, units="ns")
+
+        for block_x in range(BLOCK_WIDTH):
+            if block_x:
+                await Timer((PIXEL_SIZE - 0.5) * CLK_PERIOD_NS, units="ns")
+            await clk_edge
+            row[block_x] = rrggbb.value.integer
+
+        blocks[block_y] = np.frombuffer(row, dtype=np.uint8)
+
+    # Align to the next frame
+    await FallingEdge(dut.vsync)
+    check(BLOCK_HEIGHT - 1, blocks[BLOCK_HEIGHT - 1])
+    check_uniform(dut)
+    await hsync_edge
 
-def hex2rgb(color):
-    r = (color & 0x30) << 2 
-    if (r & 1<<6):
-        r = r | 0x3F
-    g = (color & 0xC) << 4
-    if (g & 1<<6):
-        g = g | 0x3F
-    b = (color & 0x3) << 6
-    if (b & 1<<6):
-        b = b | 0x3F
+    return blocks
 
-    return (r, g, b)
+# Wait until the design is in the state with the given counters,
+# cycles_before moves the target that many clock cycles back
+# Returns at the clock edge into that state, a transaction of
+# SpiDriver started now runs from this state on, see effect_cycles()
+async def wait_raster(dut, counter_v, counter_h, cycles_before=0):
+    htotal = WIDTH + HFRONT + HSYNC + HBACK
+    vtotal = HEIGHT + VFRONT + VSYNC + VBACK
 
-def draw_frame_software():
-    if BACKGROUND_SEL != 0:
-        print("Error: Only BACKGROUND_SEL=0 supported")
-    
-    sprite = Image.new('RGBA', (SPRITE_WIDTH, SPRITE_HEIGHT), (0, 0, 0, 0))
-    pixels = sprite.load()
-    
-    for y in range(SPRITE_HEIGHT):
-        for x in range(SPRITE_WIDTH):
-            if SPRITE[y][x]:
-                pixels[x, y] = hex2rgb(COLOR1)
-            elif ENABLE_SPRITE_BG:
-                pixels[x, y] = hex2rgb(COLOR2)
+    def position(v, h):
+        return (v + VFRONT + VSYNC + VBACK) * htotal + h + HFRONT + HSYNC + HBACK
 
-    big_sprite = sprite.resize((SPRITE_WIDTH*PIXEL_SIZE, SPRITE_HEIGHT*PIXEL_SIZE), Image.NEAREST)
+    await RisingEdge(dut.clk)
 
-    image = Image.new('RGB', (WIDTH, HEIGHT), hex2rgb(COLOR3))
-    pixels = image.load()
-    
-    image.paste(big_sprite, (SPRITE_X*PIXEL_SIZE, SPRITE_Y*PIXEL_SIZE), big_sprite)
-    
+    # The counters read at the edge are those of the state before it
+    current = position(dut.timing_ver.counter.value.signed_integer,
+                       dut.timing_hor.counter.value.signed_integer)
+
+    cycles = (position(counter_v, counter_h) - cycles_before - current - 1) % (htotal * vtotal)
+    if cycles:
+        await Timer(cycles * CLK_PERIOD_NS, units="ns")
+
+# Timing of the testbench for the scene planner
+def new_raster():
+    return scene.Raster(WIDTH, HEIGHT, HFRONT, HSYNC, HBACK,
+                        VFRONT, VSYNC, VBACK, PIXEL_SIZE)
+
+def driver_bus(spi):
+    return scene.Bus(2 * spi.half_period, cs_tail=spi.half_period, gap=spi.gap)
+
+# Send the transactions of a schedule from scene.plan()
+# at their lines, plays one frame from the next frame on
+async def play_schedule(dut, spi, schedule):
+    for line, data in schedule:
+        await wait_raster(dut, line, -(HFRONT + HSYNC + HBACK))
+        await spi.transfer(data)
+
+def sprite2bytes(sprite):
+    return list(sprite_bank.to_bytes(sprite))
+
+# Render a reference frame with a function of golden.py once for
+# every unique combination of arguments and the contents of golden.py
+# Frames are stored compressed, the least recently used
+# ones are evicted when the cache grows too large
+def render_golden(render, *args):
+    if not GOLDEN_CACHE_DIR:
+        return render(*args)
+
+    cache_dir = Path(GOLDEN_CACHE_DIR)
+
+    digest = hashlib.sha256()
+    digest.update(Path(golden.__file__).read_bytes())
+    digest.update(repr((render.__name__, args)).encode())
+
+    entry = cache_dir / f"{digest.hexdigest()[:32]}.npy.z"
+
+    try:
+        frame = np.load(io.BytesIO(zlib.decompress(entry.read_bytes())))
+        os.utime(entry)
+        return frame
+    except FileNotFoundError:
+        # Not there or just evicted
+        pass
+
+    frame = render(*args)
+
+    # Write next to the entry and publish it atomically,
+    # so concurrent tests never see a partial frame
+    buffer = io.BytesIO()
+    np.save(buffer, frame)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_entry = cache_dir / f"{entry.name}.{os.getpid()}"
+    tmp_entry.write_bytes(zlib.compress(buffer.getvalue(), 1))
+    os.replace(tmp_entry, entry)
+
+    evict_golden(cache_dir, GOLDEN_CACHE_SIZE)
+
+    return frame
+
+# Remove the least recently used frames
+# until the cache is at most size bytes
+def evict_golden(cache_dir, size):
+    entries = []
+    for entry in cache_dir.glob("*.npy.z"):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total = sum(entry_size for _, entry_size, _ in entries)
+
+    for _, entry_size, entry in sorted(entries):
+        if total <= size:
+            break
+        entry.unlink(missing_ok=True)
+        total -= entry_size
+
+def draw_frame_software(cur_time=0):
+    return render_golden(golden.render_frame,
+        SPRITE, SPRITE_X, SPRITE_Y,
+        (COLOR1, COLOR2, COLOR3, COLOR4),
+        BACKGROUND_SEL, ENABLE_SPRITE_BG, cur_time,
+        WIDTH, HEIGHT, PIXEL_SIZE
+    )
+
+# Check that both frames are the same
+def compare_frames(frame, gold):
+    return np.array_equal(frame, gold)
+
+# Image of a frame of color codes with the palette of the design
+def palette_image(frame):
+    image = Image.fromarray(np.ascontiguousarray(frame, dtype=np.uint8))
+    image.putpalette(golden.PALETTE.tobytes())
     return image
 
+def write_image(frame, filename):
+    palette_image(frame).save(filename)
+
+def write_animation(frames, filename):
+    images = [palette_image(frame) for frame in frames]
+    images[0].save(filename, save_all=True, append_images=images[1:], duration=1000 / 60, loop=0)
+
+def write_mask(mask, filename):
+    Image.fromarray(mask).save(filename)
+
+_artifact_pool = ThreadPoolExecutor(max_workers=ARTIFACT_WORKERS)
+_artifact_slots = threading.BoundedSemaphore(ARTIFACT_QUEUE)
+_artifact_pending = []
+
+# Run write(*args) on a background thread, the
+# arguments must not change until it is done
+def write_artifact(write, *args):
+    _artifact_slots.acquire()
+    future = _artifact_pool.submit(write, *args)
+    future.add_done_callback(lambda future: _artifact_slots.release())
+    _artifact_pending.append((args[-1], future))
+
+# Wait until all artifacts are written, returns
+# the errors of the writes that failed
+def wait_artifacts():
+    errors = []
+    while _artifact_pending:
+        filename, future = _artifact_pending.pop(0)
+        error = future.exception()
+        if error is not None:
+            errors.append(f"Writing {filename} failed: {error!r}")
+    return errors
+
+# Test decorator, below @cocotb.test(): the artifacts of
+# the test are written before it ends, the simulator may
+# exit without waiting for the background threads
+# A failed write fails a test that passed otherwise
+def drain_artifacts(test):
+    @functools.wraps(test)
+    async def wrapper(dut):
+        try:
+            await test(dut)
+        finally:
+            errors = wait_artifacts()
+            for error in errors:
+                dut._log.error(error)
+        if errors:
+            raise AssertionError(errors[0])
+    return wrapper
+
+# Save a frame of color codes as indexed image
+def save_frame(frame, filename):
+    if ARTIFACTS == "always":
+        write_artifact(write_image, np.array(frame), filename)
+
+# Save frames of color codes as animated GIF, 60 frames per second
+def save_animation(frames, filename):
+    if ARTIFACTS == "always":
+        write_artifact(write_animation, [np.array(frame) for frame in frames], filename)
+
+# Save the rows of a capture up to the first one that differs,
+# their references and a 1-bit mask of the differing pixels
+def save_mismatch(frame, expected, last):
+    if ARTIFACTS == "never":
+        return
+
+    frame = np.array(frame)
+    frame[last + 1:] = 0
+    expected = np.array(expected)
+
+    write_artifact(write_image, frame, "mismatch.png")
+    write_artifact(write_image, expected, "mismatch_gold.png")
+    write_artifact(write_mask, frame != expected, "mismatch_diff.png")
+
+# Sprite as the contents of the sprite shift register,
+# bit 0 is the first pixel that is drawn
+def sprite2int(sprite):
+    return sum(bit << index for index, bit in enumerate(bit for row in sprite for bit in row))
+
+# Backdoor access for tests that are not about SPI:
+# write the registers through hierarchical handles,
+# all at the same falling clock edge
+# colors is (color1, color2, color3, color4),
+# arguments and colors that are None are kept
+# The sprite is in its first position afterwards,
+# write it in the vertical blanking like over SPI
+async def backdoor_write(dut, colors=None, misc=None, sprite_x=None, sprite_y=None, sprite=None):
+    spi = dut.spi_receiver_inst
+    movement = dut.sprite_movement_inst
+
+    writes = []
+    if colors is not None:
+        writes += zip((spi.color1, spi.color2, spi.color3, spi.color4), colors)
+    writes += [(spi.misc, misc), (movement.sprite_x, sprite_x), (movement.sprite_y, sprite_y)]
+    if sprite is not None:
+        writes.append((dut.sprite_data_inst.sprite_data, sprite2int(sprite)))
+
+    await FallingEdge(dut.clk)
+
+    for handle, value in writes:
+        if value is not None:
+            handle.value = value
+
 # Send cmd and payload over SPI
 async def spi_send_cmd(dut, spi_master, cmd, data, burst=False):
     print(f'CMD: {cmd} DATA: {data}')
     await spi_master.write(cmd)
     await spi_master.write(data, burst=burst)
 
-@cocotb.test()
+@cocotb.test(skip=not SVGA)
+@drain_artifacts
 async def simple_test(dut):
     """This test sends commands to the design via SPI and
        compares the resulting frame with a software rendering"""
@@ -242,7 +662,7 @@ async def simple_test(dut):
     global ENABLE_SPRITE_BG
 
     # Start the clock
-    c = Clock(dut.clk, 10, 'ns')
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
     await cocotb.start(c.start())
 
     spi_bus = SpiBus.from_prefix(dut, "spi")
@@ -265,8 +685,8 @@ async def simple_test(dut):
     await FallingEdge(dut.vsync)
     await FallingEdge(dut.hsync)
     
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame and compare it line by line
+    taks_draw_frame = await cocotb.start(draw_frame(dut, gold=draw_frame_software))
     
     # SPI commands
     SPRITE_X = 0x10
@@ -279,17 +699,17 @@ async def simple_test(dut):
 
     dut._log.info("Config1 done")
 
-    image = await taks_draw_frame.join()
+    frame = await taks_draw_frame.join()
     gold = draw_frame_software()
 
-    image.save(f"test1.png")
-    gold.save(f"gold1.png")
+    save_frame(frame, "test1.png")
+    save_frame(gold, "gold1.png")
 
     # Check that images are the same
-    diff = ImageChops.difference(image.convert('RGB'), gold.convert('RGB'))
-    assert(not diff.getbbox())
+    assert(compare_frames(frame, gold))
 
-@cocotb.test()
+@cocotb.test(skip=not SVGA)
+@drain_artifacts
 async def create_images(dut):
     """This test creates multiple images
        of all four backgrounds"""
@@ -308,7 +728,7 @@ async def create_images(dut):
     global ENABLE_SPRITE_BG
 
     # Start the clock
-    c = Clock(dut.clk, 10, 'ns')
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
     await cocotb.start(c.start())
 
     spi_bus = SpiBus.from_prefix(dut, "spi")
@@ -331,8 +751,9 @@ async def create_images(dut):
     await FallingEdge(dut.vsync)
     await FallingEdge(dut.hsync)
     
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame and compare it line by line,
+    # the animation time advances once per frame after reset
+    taks_draw_frame = await cocotb.start(draw_frame(dut, gold=lambda: draw_frame_software(cur_time=0)))
     
     # SPI commands
     SPRITE_X = 0x13
@@ -345,11 +766,12 @@ async def create_images(dut):
 
     dut._log.info("Config1 done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"image1.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "image1.png")
 
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame and compare it line by line,
+    # the animation time advances once per frame after reset
+    taks_draw_frame = await cocotb.start(draw_frame(dut, gold=lambda: draw_frame_software(cur_time=1)))
     
     # SPI commands
     SPRITE_X = 44
@@ -368,11 +790,12 @@ async def create_images(dut):
 
     dut._log.info("Config2 done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"image2.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "image2.png")
 
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame and compare it line by line,
+    # the animation time advances once per frame after reset
+    taks_draw_frame = await cocotb.start(draw_frame(dut, gold=lambda: draw_frame_software(cur_time=2)))
     
     # SPI commands
     SPRITE_X = 0x40
@@ -392,11 +815,12 @@ async def create_images(dut):
 
     dut._log.info("Config3 done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"image3.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "image3.png")
     
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame and compare it line by line,
+    # the animation time advances once per frame after reset
+    taks_draw_frame = await cocotb.start(draw_frame(dut, gold=lambda: draw_frame_software(cur_time=3)))
     
     # SPI commands
     SPRITE_X = 0x07
@@ -416,11 +840,12 @@ async def create_images(dut):
 
     dut._log.info("Config4 done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"image4.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "image4.png")
     
     
-@cocotb.test()
+@cocotb.test(skip=not SVGA)
+@drain_artifacts
 async def draw_multiple_sprites(dut):
     """This test draws multiple identical
        sprites in one frame"""
@@ -439,7 +864,7 @@ async def draw_multiple_sprites(dut):
     global ENABLE_SPRITE_BG
 
     # Start the clock
-    c = Clock(dut.clk, 10, 'ns')
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
     await cocotb.start(c.start())
 
     spi_bus = SpiBus.from_prefix(dut, "spi")
@@ -462,8 +887,9 @@ async def draw_multiple_sprites(dut):
     await FallingEdge(dut.vsync)
     await FallingEdge(dut.hsync)
     
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame, every line is checked
+    # against the reference model running in lockstep
+    taks_draw_frame = await cocotb.start(draw_frame(dut, model=new_model()))
     
     # SPI commands
     SPRITE_X = 1+2
@@ -531,10 +957,11 @@ async def draw_multiple_sprites(dut):
 
     dut._log.info("Config done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"identical_sprites.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "identical_sprites.png")
 
-@cocotb.test()
+@cocotb.test(skip=not SVGA)
+@drain_artifacts
 async def draw_different_sprites(dut):
     """This test draws multiple different
        sprites in one frame"""
@@ -553,7 +980,7 @@ async def draw_different_sprites(dut):
     global ENABLE_SPRITE_BG
 
     # Start the clock
-    c = Clock(dut.clk, 10, 'ns')
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
     await cocotb.start(c.start())
 
     spi_bus = SpiBus.from_prefix(dut, "spi")
@@ -576,8 +1003,9 @@ async def draw_different_sprites(dut):
     await FallingEdge(dut.vsync)
     await FallingEdge(dut.hsync)
     
-    # Start thread to draw frame
-    taks_draw_frame = await cocotb.start(draw_frame(dut))
+    # Start thread to draw frame, every line is checked
+    # against the reference model running in lockstep
+    taks_draw_frame = await cocotb.start(draw_frame(dut, model=new_model()))
     
     # SPI commands
     SPRITE_X = 1+2
@@ -627,13 +1055,440 @@ async def draw_different_sprites(dut):
 
     dut._log.info("Config done")
 
-    image = await taks_draw_frame.join()
-    image.save(f"different_sprites.png")
+    frame = await taks_draw_frame.join()
+    save_frame(frame, "different_sprites.png")
 
-def test_runner():
-    hdl_toplevel_lang = os.getenv("HDL_TOPLEVEL_LANG", "verilog")
-    sim = os.getenv("SIM", "icarus") # "verilator" "icarus"
+@cocotb.test(skip=SVGA)
+@drain_artifacts
+async def functional_test(dut):
+    """This test configures the design through the backdoor
+       in the vertical blanking and compares the following
+       frame with a software rendering for all four backgrounds,
+       the blanking of the scaled-down raster is too short for SPI"""
 
+    global SPRITE
+    
+    global SPRITE_X
+    global SPRITE_Y
+    
+    global COLOR1
+    global COLOR2
+    global COLOR3
+    global COLOR4
+    
+    global BACKGROUND_SEL
+    global ENABLE_SPRITE_BG
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi_bus = SpiBus.from_prefix(dut, "spi")
+
+    spi_config = SpiConfig(
+        word_width = 8,
+        sclk_freq  = 2e6,
+        cpol       = False,
+        cpha       = True,
+        msb_first  = True,
+        frame_spacing_ns = 500
+    )
+
+    # Keeps the bus idle
+    spi_master = SpiMaster(spi_bus, spi_config)
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    # Count the completed frames for the animation time
+    frames = 0
+
+    async def count_frames():
+        nonlocal frames
+        while True:
+            # next_frame is combinational and may glitch, only
+            # count it if it is still set in the middle of the cycle
+            await RisingEdge(dut.next_frame)
+            await FallingEdge(dut.clk)
+            if dut.next_frame.value == 1:
+                frames += 1
+
+    await cocotb.start(count_frames())
+
+    configs = [
+        # sprite, x, y, color1, color3, background, sprite background
+        (SPRITE_TT,     0x13, 0x13, 0x31, 0x0C, 2, 0),
+        (SPRITE_HEART,  44,   32,   0x30, 0x2A, 0, 0),
+        (SPRITE_DRINK,  0x40, 0x20, 0x1F, 0x30, 1, 1),
+        (SPRITE_SPIRAL, 0x07, 0x07, 0x33, 0x0A, 3, 1),
+    ]
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    for i, config in enumerate(configs):
+        SPRITE, SPRITE_X, SPRITE_Y, COLOR1, COLOR3, BACKGROUND_SEL, ENABLE_SPRITE_BG = config
+
+        # Stops the movement as well
+        await backdoor_write(dut, colors=(COLOR1, None, COLOR3, None),
+                             misc=ENABLE_SPRITE_BG << 3 | BACKGROUND_SEL,
+                             sprite_x=SPRITE_X, sprite_y=SPRITE_Y, sprite=SPRITE)
+
+        dut._log.info(f"Config{i+1} done")
+
+        cur_time = golden.frame_time(frames)
+
+        frame = await draw_frame(dut, gold=draw_frame_software(cur_time=cur_time))
+        save_frame(frame, f"functional{i+1}.png")
+
+@cocotb.test()
+@drain_artifacts
+async def movement_test(dut):
+    """This test lets the sprite move from its reset position
+       over many frames of each animated background and checks
+       every frame against the trajectory of sprite_movement.sv,
+       including the bounce at the edges of the screen"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi_bus = SpiBus.from_prefix(dut, "spi")
+
+    spi_config = SpiConfig(
+        word_width = 8,
+        sclk_freq  = 2e6,
+        cpol       = False,
+        cpha       = True,
+        msb_first  = True,
+        frame_spacing_ns = 500
+    )
+
+    spi_master = SpiMaster(spi_bus, spi_config)
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    # The reference frames use the reset colors of top.sv
+    handles = state_handles(dut)
+    colors = tuple(resolve_int(handles[f"color{i}"]) for i in range(1, 5))
+    assert colors == COLORS_DEFAULT, f"Reset colors {colors} differ from COLORS_DEFAULT {COLORS_DEFAULT}"
+
+    # Count the completed frames for the position and the animation time
+    frames = 0
+
+    async def count_frames():
+        nonlocal frames
+        while True:
+            # next_frame is combinational and may glitch, only
+            # count it if it is still set in the middle of the cycle
+            await RisingEdge(dut.next_frame)
+            await FallingEdge(dut.clk)
+            if dut.next_frame.value == 1:
+                frames += 1
+
+    await cocotb.start(count_frames())
+
+    # Position of the sprite after the frames counted so far
+    trajectory = golden.sprite_trajectory(0, 0, 0, 0, 0, WIDTH // PIXEL_SIZE, HEIGHT // PIXEL_SIZE)
+    position = next(trajectory)
+    moved = 0
+
+    def gold(index):
+        nonlocal position, moved
+        while moved < frames:
+            position = next(trajectory)
+            moved += 1
+        sprite_x, sprite_y = position
+
+        return render_golden(golden.render_frame, SPRITE_TT, sprite_x, sprite_y, COLORS_DEFAULT,
+                             background, 1, golden.frame_time(frames),
+                             WIDTH, HEIGHT, PIXEL_SIZE)
+
+    for background in (1, 2, 3):
+        # Write at the start of a frame, no frame boundary may see
+        # the intermediate values of the misc register
+        await FallingEdge(dut.vsync)
+        await spi_send_cmd(dut, spi_master, [CMD_MISC], [1 << 3 | 1 << 2 | background])
+
+        dut._log.info(f"Background {background}")
+
+        await FallingEdge(dut.vsync)
+        await FallingEdge(dut.hsync)
+
+        # Frames are only kept for the animation, otherwise
+        # the stream needs constant memory
+        captured = [] if ARTIFACTS == "always" else None
+        last = None
+        async for frame in stream_frames(dut, MOVEMENT_FRAMES, gold=gold):
+            last = frame
+            if captured is not None:
+                captured.append(frame.copy())
+
+        save_frame(last, f"movement{background}.png")
+        if captured is not None:
+            save_animation(captured, f"movement{background}.gif")
+
+@cocotb.test()
+@drain_artifacts
+async def spi_driver_test(dut):
+    """This test configures the design with the in-repo SPI driver
+       at clk/4, reads the registers back over MISO and changes a
+       color exactly at the first pixel of a scanline"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi = SpiDriver(dut, CLK_PERIOD_NS)
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    colors = (0x30, 0x03, 0x0C, 0x3C)
+    sprite_x, sprite_y = 10, 40
+    misc = 1 << 3
+
+    # Everything in one transaction, the sprite
+    # is loaded long before it becomes visible
+    await FallingEdge(dut.vsync)
+    await spi.write_many([(CMD_COLOR1, [colors[0]]), (CMD_COLOR2, [colors[1]]),
+                          (CMD_COLOR3, [colors[2]]), (CMD_COLOR4, [colors[3]]),
+                          (CMD_SPRITE_X, [sprite_x]), (CMD_SPRITE_Y, [sprite_y]),
+                          (CMD_MISC, [misc]), (CMD_SPRITE_DATA, sprite2bytes(SPRITE_HEART))])
+
+    dut._log.info("Config done")
+
+    # Writing a register reads its previous value, followed by
+    # the first bits shifted in if the register is narrower
+    new_colors = (0x0F, 0x33, 0x2A, 0x15)
+
+    await FallingEdge(dut.vsync)
+    for cmd, old, new in zip((CMD_COLOR1, CMD_COLOR2, CMD_COLOR3, CMD_COLOR4), colors, new_colors):
+        read = await spi.write(cmd, [new])
+        assert read[0] == (old << 2 | new >> 6) & 0xFF, f"Read {read[0]:#04x} from command {cmd}"
+
+    read = await spi.write(CMD_MISC, [misc])
+    assert read[0] == (misc << 3 | misc >> 5) & 0xFF, f"Read {read[0]:#04x} from misc"
+
+    read = await spi.write(CMD_SPRITE_DATA, sprite2bytes(SPRITE_SPIRAL))
+    assert list(read) == sprite2bytes(SPRITE_HEART), "Read back a different sprite"
+
+    dut._log.info("Readback done")
+
+    # Solid background with color3, its new value is
+    # timed to be there for the first pixel of line
+    line = HEIGHT // 2
+    color3 = 0x03
+
+    gold = render_golden(golden.render_frame, SPRITE_SPIRAL, sprite_x, sprite_y, new_colors, 0, 1, 0,
+                         WIDTH, HEIGHT, PIXEL_SIZE)
+    gold[line:] = render_golden(golden.render_frame, SPRITE_SPIRAL, sprite_x, sprite_y,
+                                new_colors[:2] + (color3,) + new_colors[3:], 0, 1, 0,
+                                WIDTH, HEIGHT, PIXEL_SIZE)[line:]
+
+    async def scheduled_write():
+        await wait_raster(dut, line, 0, cycles_before=spi.effect_cycles(16))
+        await spi.write(CMD_COLOR3, [color3])
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    cocotb.start_soon(scheduled_write())
+    frame = await draw_frame(dut, gold=gold, model=new_model())
+
+    save_frame(frame, "spi_driver.png")
+
+@cocotb.test()
+@drain_artifacts
+async def scene_test(dut):
+    """This test stacks as many sprites into one frame as the
+       scene planner allows, plays its schedule with the in-repo
+       SPI driver and compares the frame with the software rendering
+       of the scene"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    spi = SpiDriver(dut, CLK_PERIOD_NS)
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    raster = new_raster()
+    bus = driver_bus(spi)
+
+    colors = (0x30, 0x03, 0x0C, 0x3C)
+    bands = [(0, 2), (15, 3), (30, 1), (45, 3), (60, 2)]
+
+    bitmaps = [SPRITE_TT, SPRITE_SPIRAL, SPRITE_HEART, SPRITE_DRINK] * 4
+    xs = [3, 23, 44, 64, 85, 70, 50, 30] * 2
+
+    sprites = scene.pack(bitmaps, xs, bands, raster, bus, colors=colors, sprite_bg=True)
+    schedule = scene.plan(sprites, bands, raster, bus, colors=colors, sprite_bg=True)
+
+    dut._log.info(f"{len(sprites)} sprites in {len(schedule)} transactions")
+
+    await FallingEdge(dut.vsync)
+    cocotb.start_soon(play_schedule(dut, spi, schedule))
+
+    # The schedule starts in the front porch before this frame
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    gold = render_golden(golden.render_scene, sprites, bands, colors, 1, dut.cur_time.value.integer,
+                         WIDTH, HEIGHT, PIXEL_SIZE)
+
+    frame = await draw_frame(dut, gold=gold, model=new_model())
+    save_frame(frame, "scene.png")
+
+@cocotb.test()
+@drain_artifacts
+async def block_test(dut):
+    """This test captures frames with one sample per big pixel
+       and a solid background, checks that the design only draws
+       big pixels and compares the frames at that size"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    for index, sprite in enumerate((SPRITE_TT, SPRITE_DRINK, SPRITE_HEART, SPRITE_SPIRAL)):
+        sprite_x, sprite_y = 10 + 20 * index, 5 + 15 * index
+
+        # Solid background with sprite background, no movement,
+        # loaded in the vertical blanking before the frame
+        await backdoor_write(dut, colors=COLORS_DEFAULT, misc=1 << 3,
+                             sprite_x=sprite_x, sprite_y=sprite_y, sprite=sprite)
+
+        gold = golden.to_blocks(render_golden(golden.render_frame, sprite, sprite_x, sprite_y,
+                                              COLORS_DEFAULT, 0, 1, 0, WIDTH, HEIGHT, PIXEL_SIZE),
+                                PIXEL_SIZE)
+
+        blocks = await draw_blocks(dut, gold=gold)
+        save_frame(blocks, f"blocks{index}.png")
+
+@cocotb.test()
+@drain_artifacts
+async def reduced_test(dut):
+    """This test switches to the reduced frequency mode and
+       captures two frames in a row with a moving sprite on an
+       animated background, both checked against the reference
+       model, with +FRAME_DUMP also the second frame of the dump"""
+
+    # Start the clock
+    c = Clock(dut.clk, CLK_PERIOD_NS, 'ns')
+    await cocotb.start(c.start())
+
+    # Execution will block until reset_dut has completed
+    await reset_dut(dut.reset_n, 50)
+    dut._log.info("Reset done")
+
+    # Reduced frequency mode, movement and background 2,
+    # the mode is latched at the end of the current frame
+    await backdoor_write(dut, misc=1 << 4 | 1 << 2 | 2, sprite=SPRITE_HEART)
+    await RisingEdge(dut.inc_1_or_4)
+
+    await FallingEdge(dut.vsync)
+    await FallingEdge(dut.hsync)
+
+    index = 0
+    async for frame in stream_frames(dut, 2, model=new_model()):
+        check_uniform(dut)
+        save_frame(frame, f"reduced{index}.png")
+        index += 1
+
+# Build the design once for every unique combination of
+# source contents, defines, simulator and build arguments
+def cached_build(sim, verilog_sources, defines, parameters, build_args, hdl_toplevel, cache_dir, waves=False):
+    digest = hashlib.sha256()
+    digest.update(repr((sim, hdl_toplevel, defines, parameters, build_args, waves)).encode())
+    for source in verilog_sources:
+        digest.update(Path(source).name.encode())
+        digest.update(Path(source).read_bytes())
+
+    build_dir = cache_dir / f"{sim}-{digest.hexdigest()[:16]}"
+    if build_dir.exists():
+        return build_dir
+
+    # Build next to the cache entry and publish it atomically,
+    # so concurrent runs never see a partial build
+    tmp_dir = cache_dir / f"{build_dir.name}.{os.getpid()}"
+
+    runner = get_runner(sim)
+    runner.build(
+        verilog_sources=verilog_sources,
+        defines=defines,
+        parameters=parameters,
+        build_args=build_args,
+        hdl_toplevel=hdl_toplevel,
+        build_dir=tmp_dir,
+        waves=waves,
+        always=True,
+    )
+
+    try:
+        tmp_dir.rename(build_dir)
+    except OSError:
+        # Somebody else was faster
+        shutil.rmtree(tmp_dir)
+
+    return build_dir
+
+# Run a single test in its own directory
+# on top of the shared build
+def run_testcase(sim, hdl_toplevel_lang, build_dir, test_dir, testcase, plusargs,
+                 test_module="tb_cocotb,", waves=False, extra_env=None):
+    test_dir.mkdir(parents=True, exist_ok=True)
+
+    # The runner copies the environment over its own variables,
+    # TESTCASE of the command line would select all its tests
+    os.environ.pop("TESTCASE", None)
+
+    runner = get_runner(sim)
+    runner.test(
+        hdl_toplevel="top",
+        hdl_toplevel_lang=hdl_toplevel_lang,
+        test_module=test_module,
+        testcase=testcase,
+        plusargs=plusargs,
+        build_dir=build_dir,
+        test_dir=test_dir,
+        results_xml=test_dir / "results.xml",
+        waves=waves,
+        extra_env=extra_env or {},
+    )
+
+# Merge the JUnit results of all tests into
+# one file and return the number of failures
+def merge_results(results_files, merged_file):
+    merged = ET.Element("testsuites", name="results")
+    failures = 0
+
+    for results_file in results_files:
+        for testsuite in ET.parse(results_file).getroot().iter("testsuite"):
+            merged.append(testsuite)
+            for testcase in testsuite.iter("testcase"):
+                if testcase.find("failure") is not None or testcase.find("error") is not None:
+                    failures += 1
+
+    ET.ElementTree(merged).write(merged_file, encoding="utf-8", xml_declaration=True)
+    return failures
+
+# Build the design for the cocotb tests
+def build_design(sim, cache_dir, waves=False, threads=1):
     proj_path = Path(__file__).resolve().parent
 
     verilog_sources = [proj_path / "../src/top.sv",
@@ -643,18 +1498,80 @@ def test_runner():
                         proj_path / "../src/background.sv",
                         proj_path / "../src/timing.sv",
                         proj_path / "../src/synchronizer.sv",
-                        proj_path / "../src/spi_receiver.sv"]
-
-    runner = get_runner(sim)
-    runner.build(
+                        proj_path / "../src/spi_receiver.sv",
+                        proj_path / "frame_capture.sv"]
+
+    build_args = []
+    if sim == "verilator":
+        # Waivers for the width warnings of the existing RTL,
+        # every other warning still fails the build
+        verilog_sources.append(proj_path / "verilator.vlt")
+
+        # The simulation context gets one thread per available CPU,
+        # a model built for more threads than that refuses to run
+        available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        if threads > available:
+            print(f"THREADS={threads} limited to the {available} available CPUs")
+            threads = available
+        build_args += ["--threads", str(threads)]
+        if waves:
+            build_args += ["--trace-fst", "--trace-structs"]
+
+    return cached_build(
+        sim,
         verilog_sources=verilog_sources,
         defines=[("COCOTB", 1)],
-        build_args=[],#["--trace-fst", "--trace-structs"],
+        parameters={"PIXEL_SIZE": PIXEL_SIZE},
+        build_args=build_args,
         hdl_toplevel="top",
-        always=True,
+        cache_dir=cache_dir,
+        waves=waves,
     )
 
-    runner.test(hdl_toplevel="top", test_module="tb_cocotb,")
+def test_runner():
+    hdl_toplevel_lang = os.getenv("HDL_TOPLEVEL_LANG", "verilog")
+    sim = os.getenv("SIM", "icarus") # "verilator" "icarus"
+    workers = int(os.getenv("WORKERS", os.cpu_count()))
+    waves = os.getenv("WAVES", "0") == "1"
+    threads = int(os.getenv("THREADS", 1)) # verilator only
+
+    sim_dir = Path("sim_build").resolve()
+    cache_dir = Path(os.getenv("BUILD_CACHE", sim_dir / "cache")).resolve()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    plusargs = []
+    if os.getenv("FRAME_DUMP", "0") == "1":
+        plusargs.append(f"+{FRAME_DUMP_PLUSARG}={FRAME_DUMP_FILE}")
+
+    build_dir = build_design(sim, cache_dir, waves=waves, threads=threads)
+
+    # Set GOLDEN_CACHE=0 to render every reference frame
+    extra_env = {}
+    if os.getenv("GOLDEN_CACHE", "1") == "1":
+        extra_env["GOLDEN_CACHE_DIR"] = str(cache_dir / "golden")
+
+    # Same discovery as the cocotb regression manager
+    testcases = [name for name, obj in globals().items()
+                 if getattr(obj, "im_test", False) and not getattr(obj, "skip", False)]
+    if os.getenv("TESTCASE"):
+        testcases = [name for name in testcases if name in os.getenv("TESTCASE").split(",")]
+
+    # One simulator process per test
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(testcases)))) as pool:
+        futures = {testcase: pool.submit(run_testcase, sim, hdl_toplevel_lang, build_dir,
+                                         sim_dir / testcase, testcase, plusargs, waves=waves,
+                                         extra_env=extra_env)
+                   for testcase in testcases}
+        errors = {testcase: future.exception() for testcase, future in futures.items()}
+
+    results_files = [sim_dir / testcase / "results.xml" for testcase in testcases]
+    failures = merge_results([f for f in results_files if f.exists()], sim_dir / "results.xml")
+
+    for testcase, error in errors.items():
+        if error:
+            print(f"{testcase}: {error}")
+
+    assert not failures and not any(errors.values()), f"Failing tests, see {sim_dir / 'results.xml'}"
 
 
 if __name__ == "__main__":